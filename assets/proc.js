@@ -53,7 +53,7 @@ function loadData() {
     fillTable();
     startAutoScroll();
     if (rawData.will_run) {
-        setTimeout(checkForUpdates, 5000);
+        setTimeout(checkForUpdates, 2000);
     }
 }
 
@@ -299,6 +299,7 @@ function getXAxisContent(x, y, xAxis, yval, x2Axis, x2val, y2Axis, y2val) {
     let newContent = '';
     let subInd = 0;
     let scoreDisplay = document.getElementById('score_display').value;
+    let thumbWidth = getThumbnailWidth();
     for (let xVal of xAxis.values) {
         subInd++;
         if (!canShowVal(xAxis.id, xVal.key)) {
@@ -313,12 +314,18 @@ function getXAxisContent(x, y, xAxis, yval, x2Axis, x2val, y2Axis, y2val) {
         if (ext == 'mp4' || ext == 'webm') {
             newContent += `<video loop autoplay muted class="table_img" data-img_path="${slashed}" onclick="doPopupFor(this)" onerror="setImgPlaceholder(this)" alt="${actualUrl}"><source src="${actualUrl}" type="video/${ext}"></source></video>`;
         }
+        else if (thumbWidth != null && ext == rawData.ext) {
+            newContent += `<img class="table_img" data-img_path="${slashed}" data-thumb_width="${thumbWidth}" onclick="doPopupFor(this)" onerror="setImgPlaceholder(this)" src="thumbs/${thumbWidth}/${slashed}.webp" alt="${actualUrl}" loading="lazy" />`;
+        }
         else {
-            newContent += `<img class="table_img" data-img_path="${slashed}" onclick="doPopupFor(this)" onerror="setImgPlaceholder(this)" src="${actualUrl}" alt="${actualUrl}" />`;
+            newContent += `<img class="table_img" data-img_path="${slashed}" onclick="doPopupFor(this)" onerror="setImgPlaceholder(this)" src="${actualUrl}" alt="${actualUrl}" loading="lazy" />`;
         }
         newContent += '</td>';
         let newScr = null;
-        if (typeof getMetadataScriptFor != 'undefined') {
+        if ('metadata_shard_depth' in rawData) {
+            loadMetadataFor(slashed, false);
+        }
+        else if (typeof getMetadataScriptFor != 'undefined') {
             newScr = document.createElement('script');
             newScr.src = getMetadataScriptFor(slashed);
         }
@@ -396,6 +403,12 @@ function setImgPlaceholder(img) {
     if (!img.parentElement) {
         return;
     }
+    if (img.dataset.thumb_width) {
+        // The thumbnail may not be made yet, so try the full image before giving up
+        delete img.dataset.thumb_width;
+        img.src = getFullImageUrl(img);
+        return;
+    }
     img.onerror = undefined;
     img.dataset.errored_src = img.src;
     img.src = 'placeholder.png';
@@ -410,6 +423,13 @@ function optDescribe(isFirst, val) {
     return isFirst && val != null ? '<span title="' + escapeHtml(val.description) + '"><b>' + escapeHtml(val.title) + '</b></span><br>' : (val != null ? '<br>' : '');
 }
 
+/** Tables with at least this many image cells only render the cells around the visible area. */
+const VIRTUAL_TABLE_MIN_CELLS = 1000;
+/** Extra rows and columns to render past each edge of the visible area. */
+const VIRTUAL_TABLE_MARGIN = 3;
+
+let virtualTable = null;
+
 function fillTable() {
     if (suppressUpdate) {
         return;
@@ -423,8 +443,7 @@ function fillTable() {
     var yAxis = getAxisById(y);
     var x2Axis = x2 == 'None' || x2 == x || x2 == y ? null : getAxisById(x2);
     var y2Axis = y2 == 'None' || y2 == x2 || y2 == x || y2 == y ? null : getAxisById(y2);
-    var table = document.getElementById('image_table');
-    var newContent = '<tr id="image_table_header" class="sticky_top"><th></th>';
+    var columns = [];
     var superFirst = true;
     document.getElementById('image_script_dump').innerHTML = '';
     for (var x2val of (x2Axis == null ? [null] : x2Axis.values)) {
@@ -436,12 +455,12 @@ function fillTable() {
             if (!canShowVal(xAxis.id, val.key)) {
                 continue;
             }
-            newContent += `<th${(superFirst ? '' : ' class="superaxis_second"')} title="${val.description.replaceAll('"', '&quot;')}">${optDescribe(x2first, x2val)}<b>${escapeHtml(val.title)}</b></th>`;
+            columns.push({ x2val: x2val, val: val, header: `<th${(superFirst ? '' : ' class="superaxis_second"')} title="${val.description.replaceAll('"', '&quot;')}">${optDescribe(x2first, x2val)}<b>${escapeHtml(val.title)}</b></th>` });
             x2first = false;
         }
         superFirst = !superFirst;
     }
-    newContent += '</tr>';
+    var rows = [];
     superFirst = true;
     for (var y2val of (y2Axis == null ? [null] : y2Axis.values)) {
         if (y2val != null && !canShowVal(y2Axis.id, y2val.key)) {
@@ -452,25 +471,137 @@ function fillTable() {
             if (!canShowVal(yAxis.id, val.key)) {
                 continue;
             }
-            newContent += `<tr><td class="axis_label_td${(superFirst ? '' : ' superaxis_second')}" title="${escapeHtml(val.description)}">${optDescribe(y2first, y2val)}<b>${escapeHtml(val.title)}</b></td>`;
+            rows.push({ y2val: y2val, val: val, label: `<td class="axis_label_td${(superFirst ? '' : ' superaxis_second')}" title="${escapeHtml(val.description)}">${optDescribe(y2first, y2val)}<b>${escapeHtml(val.title)}</b></td>` });
             y2first = false;
-            for (var x2val of (x2Axis == null ? [null] : x2Axis.values)) {
-                if (x2val != null && !canShowVal(x2Axis.id, x2val.key)) {
-                    continue;
-                }
-                newContent += getXAxisContent(x, y, xAxis, val, x2Axis, x2val, y2Axis, y2val);
-            }
-            newContent += '</tr>';
             if (x == y) {
                 break;
             }
         }
         superFirst = !superFirst;
     }
-    table.innerHTML = newContent;
+    let old = virtualTable;
+    virtualTable = { x, y, xAxis, x2Axis, y2Axis, columns, rows, rowRange: null, colRange: null, pending: false,
+        rowHeight: old ? old.rowHeight : 200, colWidth: old ? old.colWidth : 200,
+        showAll: rows.length * columns.length < VIRTUAL_TABLE_MIN_CELLS };
+    renderVirtualTable();
     updateScaling();
 }
 
+function getVisibleRange(offset, size, visible, count, margin) {
+    let first = Math.max(0, Math.floor(offset / size));
+    return [Math.max(0, first - margin), Math.min(count, first + Math.ceil(visible / size) + 1 + margin)];
+}
+
+function getWantedVirtualRanges(margin) {
+    let vt = virtualTable;
+    if (vt.showAll) {
+        return [[0, vt.rows.length], [0, vt.columns.length]];
+    }
+    let rect = document.getElementById('image_table').getBoundingClientRect();
+    let header = document.getElementById('image_table_header');
+    let headerHeight = header ? header.getBoundingClientRect().height : 0;
+    let label = document.querySelector('#image_table .axis_label_td');
+    let labelWidth = label ? label.getBoundingClientRect().width : 0;
+    return [getVisibleRange(-rect.top - headerHeight, vt.rowHeight, window.innerHeight, vt.rows.length, margin),
+        getVisibleRange(-rect.left - labelWidth, vt.colWidth, window.innerWidth, vt.columns.length, margin)];
+}
+
+function renderVirtualTable() {
+    let vt = virtualTable;
+    let [rowRange, colRange] = getWantedVirtualRanges(VIRTUAL_TABLE_MARGIN);
+    vt.rowRange = rowRange;
+    vt.colRange = colRange;
+    let spacer = (tag, style) => `<${tag} class="virtual_spacer" style="padding: 0; border: 0; ${style}"></${tag}>`;
+    let leftSpacer = colRange[0] > 0 ? `min-width: ${colRange[0] * vt.colWidth}px` : null;
+    let rightSpacer = colRange[1] < vt.columns.length ? `min-width: ${(vt.columns.length - colRange[1]) * vt.colWidth}px` : null;
+    let shownColumns = vt.columns.slice(colRange[0], colRange[1]);
+    let newContent = '<tr id="image_table_header" class="sticky_top"><th></th>';
+    newContent += leftSpacer ? spacer('th', leftSpacer) : '';
+    newContent += shownColumns.map(column => column.header).join('');
+    newContent += rightSpacer ? spacer('th', rightSpacer) : '';
+    newContent += '</tr>';
+    if (rowRange[0] > 0) {
+        newContent += `<tr>${spacer('td', `height: ${rowRange[0] * vt.rowHeight}px`)}</tr>`;
+    }
+    for (let row of vt.rows.slice(rowRange[0], rowRange[1])) {
+        newContent += '<tr>' + row.label + (leftSpacer ? spacer('td', leftSpacer) : '');
+        // Group the shown columns by super-axis value, as getXAxisContent fills one x2 value at a time
+        let start = 0;
+        while (start < shownColumns.length) {
+            let end = start;
+            while (end < shownColumns.length && shownColumns[end].x2val == shownColumns[start].x2val) {
+                end++;
+            }
+            let xAxisPart = { id: vt.xAxis.id, values: shownColumns.slice(start, end).map(column => column.val) };
+            newContent += getXAxisContent(vt.x, vt.y, xAxisPart, row.val, vt.x2Axis, shownColumns[start].x2val, vt.y2Axis, row.y2val);
+            start = end;
+        }
+        newContent += (rightSpacer ? spacer('td', rightSpacer) : '') + '</tr>';
+    }
+    if (rowRange[1] < vt.rows.length) {
+        newContent += `<tr>${spacer('td', `height: ${(vt.rows.length - rowRange[1]) * vt.rowHeight}px`)}</tr>`;
+    }
+    document.getElementById('image_table').innerHTML = newContent;
+}
+
+function measureVirtualTable() {
+    let vt = virtualTable;
+    let cells = Array.from(document.querySelectorAll('#image_table img.table_img')).filter(image => image.complete && image.naturalWidth > 0).map(image => image.parentElement);
+    if (cells.length == 0) {
+        return false;
+    }
+    let rows = new Set(cells.map(cell => cell.parentElement));
+    let rowHeight = Array.from(rows).reduce((sum, row) => sum + row.getBoundingClientRect().height, 0) / rows.size;
+    let colWidth = cells.reduce((sum, cell) => sum + cell.getBoundingClientRect().width, 0) / cells.length;
+    let changed = Math.abs(rowHeight - vt.rowHeight) > 2 || Math.abs(colWidth - vt.colWidth) > 2;
+    if (rowHeight > 0 && colWidth > 0) {
+        vt.rowHeight = rowHeight;
+        vt.colWidth = colWidth;
+    }
+    return changed;
+}
+
+function updateVirtualTable() {
+    let vt = virtualTable;
+    if (vt == null || vt.showAll || vt.pending) {
+        return;
+    }
+    vt.pending = true;
+    requestAnimationFrame(() => {
+        vt.pending = false;
+        if (vt != virtualTable) {
+            return;
+        }
+        let resized = measureVirtualTable();
+        let [rowRange, colRange] = getWantedVirtualRanges(0);
+        let inside = (range, rendered) => range[0] >= rendered[0] && range[1] <= rendered[1];
+        if (resized || !inside(rowRange, vt.rowRange) || !inside(colRange, vt.colRange)) {
+            renderVirtualTable();
+            updateScaling();
+        }
+    });
+}
+
+window.addEventListener('scroll', updateVirtualTable);
+window.addEventListener('resize', updateVirtualTable);
+// Image loads change the size of cells, so the rendered window may need adjusting
+document.addEventListener('load', event => {
+    if (event.target.classList && event.target.classList.contains('table_img')) {
+        updateVirtualTable();
+    }
+}, true);
+
+/** Renders every cell (eg for exporting), until the table is next filled. */
+function showWholeTable() {
+    if (virtualTable == null || virtualTable.showAll) {
+        return false;
+    }
+    virtualTable.showAll = true;
+    renderVirtualTable();
+    updateScaling();
+    return true;
+}
+
 function getCurrentSelectedAxis(axisPrefix) {
     var id = document.querySelector(`input[name="${axisPrefix}_axis_selector"]:checked`).id;
     var index = id.indexOf('_');
@@ -496,6 +627,65 @@ function getWantedScaling() {
     return (90 / count);
 }
 
+function getThumbnailWidth() {
+    if (!rawData.thumbnails) {
+        return null;
+    }
+    let percent = getWantedScaling();
+    if (percent == 0) {
+        return null;
+    }
+    let pixels = percent * window.innerWidth / 100 * (window.devicePixelRatio || 1);
+    for (let width of rawData.thumbnails) {
+        if (width >= pixels) {
+            return width;
+        }
+    }
+    return null;
+}
+
+function getFullImageUrl(img) {
+    let path = img.dataset.img_path;
+    return path + '.' + getExtension(path);
+}
+
+function upgradeThumbnails() {
+    let wanted = getThumbnailWidth();
+    for (let image of document.getElementById('image_table').querySelectorAll('img[data-thumb_width]')) {
+        if (wanted == null) {
+            delete image.dataset.thumb_width;
+            image.src = getFullImageUrl(image);
+        }
+        else if (parseInt(image.dataset.thumb_width) < wanted) {
+            image.dataset.thumb_width = wanted;
+            image.src = `thumbs/${wanted}/${image.dataset.img_path}.webp`;
+        }
+    }
+}
+
+function loadFullResolution(callback) {
+    let waiting = 1;
+    let done = () => {
+        if (--waiting == 0) {
+            callback();
+        }
+    };
+    for (let image of document.querySelectorAll('#image_table img.table_img')) {
+        if (!image.dataset.thumb_width && image.complete) {
+            continue;
+        }
+        waiting++;
+        image.loading = 'eager';
+        image.addEventListener('load', done, { once: true });
+        image.addEventListener('error', done, { once: true });
+        if (image.dataset.thumb_width) {
+            delete image.dataset.thumb_width;
+            image.src = getFullImageUrl(image);
+        }
+    }
+    done();
+}
+
 function setImageScale(image, percent) {
     let heatmapper = image.parentElement.getElementsByClassName('heatmapper')[0];
     if (percent == 0) {
@@ -524,6 +714,7 @@ function setImageScale(image, percent) {
 }
 
 function updateScaling() {
+    upgradeThumbnails();
     let percent = getWantedScaling();
     for (var image of document.getElementById('image_table').getElementsByClassName('table_img')) {
         setImageScale(image, percent);
@@ -630,6 +821,53 @@ async function startAutoScroll() {
     }
 }
 
+let gridMetadata = {};
+let loadedMetadataShards = {};
+let metadataShardLoads = 0;
+
+/** External callable, from metadata shard files. */
+function gridMeta(path, data) {
+    gridMetadata[path] = data;
+}
+
+function loadMetadataFor(path, reload) {
+    let shard = path.split('/').slice(0, rawData.metadata_shard_depth).join('/') || 'index';
+    if (shard in loadedMetadataShards && !reload) {
+        if (loadedMetadataShards[shard] === true) {
+            loadMissingMetadata([path]);
+        }
+        else {
+            loadedMetadataShards[shard].push(path);
+        }
+        return;
+    }
+    let waiting = [path];
+    let newScr = document.createElement('script');
+    newScr.src = `meta/${shard}.js` + (reload ? `?vary=${metadataShardLoads++}` : '');
+    loadedMetadataShards[shard] = waiting;
+    document.body.appendChild(newScr);
+    let done = () => {
+        newScr.remove();
+        loadedMetadataShards[shard] = true;
+        loadMissingMetadata(waiting);
+    };
+    newScr.onload = done;
+    newScr.onerror = done;
+}
+
+function loadMissingMetadata(paths) {
+    if (typeof getMetadataScriptFor == 'undefined') {
+        return;
+    }
+    for (let path of paths) {
+        if (!(path in gridMetadata)) {
+            let newScr = document.createElement('script');
+            newScr.src = getMetadataScriptFor(path);
+            document.getElementById('image_script_dump').appendChild(newScr);
+        }
+    }
+}
+
 function crunchMetadata(parts) {
     if (!('metadata' in rawData)) {
         return {};
@@ -662,6 +900,9 @@ function doPopupFor(img) {
     if (typeof getMetadataForImage != 'undefined') {
         metaText = getMetadataForImage(img);
     }
+    else if (img.dataset.img_path in gridMetadata && gridMetadata[img.dataset.img_path].parameters) {
+        metaText = gridMetadata[img.dataset.img_path].parameters;
+    }
     else {
         let imgPath = img.dataset.img_path.split('/');
         let metaData = crunchMetadata(imgPath);
@@ -669,7 +910,7 @@ function doPopupFor(img) {
     }
     let params = escapeHtml(metaText).replaceAll('\n', '\n<br>');
     let text = 'Image: ' + img.alt + (params.length > 1 ? ', parameters: <br>' + params : '<br>(parameters hidden)');
-    modalElem.innerHTML = `<div class="modal-dialog" style="display:none">(click outside image to close)</div><div class="modal_inner_div"><img onclick="$('#image_info_modal').modal('hide')" class="popup_modal_img" src="${img.src}"><br><div class="popup_modal_undertext">${text}</div>`;
+    modalElem.innerHTML = `<div class="modal-dialog" style="display:none">(click outside image to close)</div><div class="modal_inner_div"><img onclick="$('#image_info_modal').modal('hide')" class="popup_modal_img" src="${img.dataset.errored_src || !img.dataset.img_path ? img.src : getFullImageUrl(img)}"><br><div class="popup_modal_undertext">${text}</div>`;
     $('#image_info_modal').modal('toggle');
 }
 
@@ -723,6 +964,11 @@ function removeGeneratedImages() {
 }
 
 function makeImage(minRow = 0, doClear = true) {
+    showWholeTable();
+    if (Array.from(document.querySelectorAll('#image_table img.table_img')).some(img => img.dataset.thumb_width || !img.complete)) {
+        loadFullResolution(() => makeImage(minRow, doClear));
+        return;
+    }
     // Preprocess data
     var imageTable = document.getElementById('image_table');
     var rows = Array.from(imageTable.getElementsByTagName('tr')).filter(e => e.getElementsByTagName('img').length > 0);
@@ -1047,7 +1293,10 @@ function applyHash(hash) {
 
 let lastUpdateObj = null;
 let updateCheckCount = 0;
-let updatesWithoutData = 0;
+let updateCheckFailures = 0;
+let liveSegment = 0;
+let liveSeq = -1;
+let liveUpdatesFound = 0;
 
 function tryReloadImg(img) {
     let target = img.dataset.errored_src;
@@ -1058,42 +1307,63 @@ function tryReloadImg(img) {
         setImgPlaceholder(img);
     });
     img.src = target;
-    if (typeof getMetadataScriptFor != 'undefined') {
+    if ('metadata_shard_depth' in rawData) {
+        loadMetadataFor(img.dataset.img_path, true);
+    }
+    else if (typeof getMetadataScriptFor != 'undefined') {
         let newScr = document.createElement('script');
         newScr.src = getMetadataScriptFor(img.dataset.img_path);
         document.getElementById('image_script_dump').appendChild(newScr);
     }
 }
 
-function checkForUpdates() {
-    if (!window.lastUpdated) {
-        if (updatesWithoutData++ > 2) {
-            console.log('Update-checker has no more updates.');
-            for (let img of document.querySelectorAll(`img[data-errored_src]`)) {
-                tryReloadImg(img);
-            }
-            return;
-        }
+/** External callable, from the live update log. */
+function liveUpdate(seq, url) {
+    if (seq <= liveSeq) {
+        return;
     }
-    else {
-        console.log(`Update-checker found ${window.lastUpdated.length} updates.`);
-        for (let url of window.lastUpdated) {
-            for (let img of document.querySelectorAll(`img[data-errored_src]`)) {
-                if (img.dataset.errored_src.endsWith(url)) {
-                    tryReloadImg(img);
-                }
-            }
+    liveSeq = seq;
+    liveUpdatesFound++;
+    for (let img of document.querySelectorAll(`img[data-errored_src]`)) {
+        if (img.dataset.errored_src.endsWith(url)) {
+            tryReloadImg(img);
         }
-        updateScaling();
-        window.lastUpdated = null;
     }
+}
+
+/** External callable, from the live update log. */
+function liveUpdateNext(segment) {
+    liveSegment = Math.max(liveSegment, segment);
+}
+
+function checkForUpdates() {
     if (lastUpdateObj != null) {
         lastUpdateObj.remove();
     }
+    let segment = liveSegment;
+    liveUpdatesFound = 0;
     lastUpdateObj = document.createElement('script');
-    lastUpdateObj.src = `last.js?vary=${updateCheckCount++}`;
+    lastUpdateObj.onload = function() {
+        updateCheckFailures = 0;
+        if (liveUpdatesFound > 0) {
+            console.log(`Update-checker found ${liveUpdatesFound} updates.`);
+            updateScaling();
+        }
+        setTimeout(checkForUpdates, liveSegment != segment ? 0 : 2 * 1000);
+    };
+    lastUpdateObj.onerror = function() {
+        // The log is removed once the grid is done running
+        if (updateCheckFailures++ > 2) {
+            console.log('Update-checker has no more updates.');
+            for (let img of document.querySelectorAll(`img[data-errored_src]`)) {
+                tryReloadImg(img);
+            }
+            return;
+        }
+        setTimeout(checkForUpdates, 2 * 1000);
+    };
+    lastUpdateObj.src = `live/${segment}.js?vary=${updateCheckCount++}`;
     document.body.appendChild(lastUpdateObj);
-    setTimeout(checkForUpdates, 5 * 1000);
 }
 
 loadData();
@@ -1,8 +1,11 @@
 # This file is part of Infinity Grid Generator, view the README.md at https://github.com/mcmonkeyprojects/sd-infinity-grid-generator-script for more information.
 
-import os, glob, yaml, json, shutil, math, re, time
+import os, glob, yaml, json, shutil, math, re, time, hashlib, threading, pickle, zlib, struct, argparse, itertools, subprocess, random, io, base64, urllib.request, urllib.error, asyncio, contextlib, dataclasses, enum
+from collections import OrderedDict
+from collections.abc import Mapping
 from copy import copy
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont, GifImagePlugin, PngImagePlugin
 from git import Repo
 
 ######################### Core Variables #########################
@@ -13,10 +16,19 @@ EXTRA_ASSETS = []
 VERSION = None
 valid_modes = {}
 IMAGES_CACHE = None
+NAME_INDEX_CACHE = {}
+PARSE_CACHE_DIR = os.path.dirname(__file__) + "/.cache/parse"
+THUMBNAIL_WIDTHS = [128, 256, 512]
+WILL_RUN_MARKER = "\nrawData.will_run = true;\n"
+# How many recently generated images a run remembers to spot duplicates of, so memory stays flat on huge grids
+DEDUPLICATE_WINDOW = 100000
+# When set, a prompt replace whose text is in neither the prompt nor the negative prompt is an error rather than doing nothing
+VALIDATE_REPLACE = False
 
 ######################### Hooks #########################
 
 # hook(SingleGridCall)
+# SingleGridCall has fixed slots, so hooks can't add attributes to it: any data a hook keeps per image goes in its 'hook_data' dict (None until a hook creates it)
 grid_call_init_hook: callable = None
 # hook(SingleGridCall, param_name: str, value: any) -> bool
 grid_call_param_add_hook: callable = None
@@ -27,11 +39,22 @@ grid_runner_pre_run_hook: callable = None
 # hook(GridRunner)
 grid_runner_pre_dry_hook: callable = None
 # hook(GridRunner, PassThroughObject, set: SingleGridCall) -> ResultObject
+# Once an image file is fully written, the hook (or its save thread) should call GridRunner.on_image_saved(set)
+# If GridRunner.save_queue is set, saving should be submitted to it rather than done inline
+# The hook may call GridRunner.add_image_metadata(set, data) to publish the actual generation info of the image to the web viewer
 grid_runner_post_dry_hook: callable = None
+# hook(GridRunner, batch: list[(PassThroughObject, SingleGridCall)]) -> ResultObject
+grid_runner_post_dry_batch_hook: callable = None
 # hook(GridRunner, SingleGridCall) -> int
 grid_runner_count_steps: callable = None
 # hook(PassThroughObject) -> dict
 webdata_get_base_param_data: callable = None
+# hook(PassThroughObject) -> dict of settings that change the image but aren't in the base param data (eg highres fix or extension args)
+# Included in param hashes, so values must be plain data, images or arrays (see get_state_data)
+grid_runner_get_extra_state: callable = None
+# Any number of listener(name: str, category: str, start: float, duration: float, args: dict), each called for every timed span of a grid run (see GridProfiler)
+# 'start' is from time.perf_counter(), and the span may have run on any thread
+profile_listeners: list = []
 
 ######################### Utilities #########################
 
@@ -44,6 +67,29 @@ def clean_file_path(fn: str):
         fn = fn.replace('//', '/')
     return fn
 
+class UnhashableState(Exception):
+    pass
+
+def get_state_data(val, depth: int = 0):
+    """Converts generation state to plain data for hashing, with images and arrays reduced to a hash of their content."""
+    if depth > 8:
+        raise UnhashableState("nested too deeply")
+    if val is None or isinstance(val, (bool, int, float, str)):
+        return val
+    if isinstance(val, enum.Enum):
+        return val.name
+    if isinstance(val, (list, tuple)):
+        return [get_state_data(v, depth + 1) for v in val]
+    if isinstance(val, dict):
+        return {str(k): get_state_data(v, depth + 1) for k, v in val.items()}
+    if isinstance(val, Image.Image):
+        return f"image {val.mode} {val.size} " + hashlib.sha256(val.tobytes()).hexdigest()
+    if hasattr(val, 'tobytes') and hasattr(val, 'shape'):
+        return f"array {val.dtype} {val.shape} " + hashlib.sha256(val.tobytes()).hexdigest()
+    if dataclasses.is_dataclass(val):
+        return {'type': type(val).__name__, 'fields': get_state_data({field.name: getattr(val, field.name) for field in dataclasses.fields(val)}, depth + 1)}
+    raise UnhashableState(f"can't hash a '{type(val).__name__}'")
+
 def get_version():
     global VERSION
     if VERSION is not None:
@@ -75,6 +121,7 @@ def list_image_files():
 def clear_caches():
     global IMAGES_CACHE
     IMAGES_CACHE = None
+    NAME_INDEX_CACHE.clear()
 
 def get_name_list():
     file_list = glob.glob(ASSET_DIR + "/*.yml")
@@ -118,6 +165,58 @@ def get_best_in_list(name: str, list: list):
                 best_len = len(list_val_clean)
     return backup
 
+class NameIndex:
+    """Lookup over a list of names that gives the same results as 'get_best_in_list' without rescanning the list."""
+    def __init__(self, names):
+        self.names = list(names)
+        cleaned = [clean_name(x) for x in self.names]
+        self.exact = dict()
+        self.trigrams = dict()
+        for i, name in enumerate(cleaned):
+            self.exact.setdefault(name, i)
+            for gram in {name[x:x + 3] for x in range(len(name) - 2)}:
+                self.trigrams.setdefault(gram, list()).append(i)
+        self.by_length = sorted(range(len(cleaned)), key=lambda i: (len(cleaned[i]), i))
+        self.cleaned = cleaned
+        self.memo = dict()
+
+    def find(self, name: str):
+        name = clean_name(name)
+        if name in self.memo:
+            return self.memo[name]
+        result = self.find_uncached(name)
+        self.memo[name] = result
+        return result
+
+    def find_uncached(self, name: str):
+        if name in self.exact:
+            return self.names[self.exact[name]]
+        if len(name) < 3:
+            for i in self.by_length:
+                if name in self.cleaned[i]:
+                    return self.names[i]
+            return None
+        postings = [self.trigrams.get(name[x:x + 3]) for x in range(len(name) - 2)]
+        if any(x is None for x in postings):
+            return None
+        candidates = set(min(postings, key=len))
+        for posting in postings:
+            candidates.intersection_update(posting)
+            if len(candidates) == 0:
+                return None
+        best = None
+        for i in candidates:
+            if name in self.cleaned[i] and (best is None or (len(self.cleaned[i]), i) < (len(self.cleaned[best]), best)):
+                best = i
+        return None if best is None else self.names[best]
+
+def get_name_index(key: str, list_func: callable):
+    index = NAME_INDEX_CACHE.get(key)
+    if index is None:
+        index = NameIndex(list_func())
+        NAME_INDEX_CACHE[key] = index
+    return index
+
 def choose_better_file_name(raw_name: str, full_name: str):
     partial_name = os.path.splitext(os.path.basename(full_name))[0]
     if '/' in raw_name or '\\' in raw_name or '.' in raw_name or len(raw_name) >= len(partial_name):
@@ -149,6 +248,63 @@ def expand_numeric_list_ranges(in_list, num_type):
             out_list.append(num_type(raw_val))
     return out_list
 
+class GridProfiler:
+    """Times the phases of a grid run and the stages of each image, for 'profile_listeners' and optionally a Chrome trace timeline."""
+    def __init__(self, record: bool = False):
+        self.record = record
+        self.listeners = list(profile_listeners)
+        self.enabled = record or len(self.listeners) > 0
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = list()
+        self.thread_names = dict()
+        self.totals = dict()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "phase", **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter(), args)
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict = None, pid: int = None, tid: int = None, thread_name: str = None):
+        """Adds a span that was timed elsewhere."""
+        if not self.enabled:
+            return
+        for listener in self.listeners:
+            listener(name, category, start, end - start, args or {})
+        if not self.record:
+            return
+        pid = pid or os.getpid()
+        if tid is None:
+            tid = threading.get_ident()
+            thread_name = thread_name or threading.current_thread().name
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round((start - self.origin) * 1e6, 1), 'dur': round((end - start) * 1e6, 1), 'pid': pid, 'tid': tid}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+            if thread_name is not None:
+                self.thread_names.setdefault((pid, tid), thread_name)
+            count, total = self.totals.get((category, name), (0, 0))
+            self.totals[(category, name)] = (count + 1, total + end - start)
+
+    def write(self, path: str):
+        with self.lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for (pid, tid), name in self.thread_names.items()]
+            with open(path + ".tmp", 'w', encoding="utf-8") as f:
+                json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, f, default=str)
+        os.replace(path + ".tmp", path)
+
+    def summary(self, category: str):
+        with self.lock:
+            totals = [(name, count, total) for (cat, name), (count, total) in self.totals.items() if cat == category]
+        return [f"{name}: {total:.2f}s" + (f" over {count}" if count > 1 else "") for name, count, total in sorted(totals, key=lambda t: -t[2])]
+
 ######################### Value Modes #########################
 
 class GridSettingMode:
@@ -162,8 +318,10 @@ class GridSettingMode:
     'valid_list' is for text type, an optional lambda that returns a list of valid values
     'clean' is an optional function to call that takes (passthroughObject, value) and returns a cleaned copy of the value, or raises an error if invalid
     'parse_list' is an optional function to call that takes a List and returns a List, to apply any special pre-processing for list-format inputs.
+    'switch_cost' is an optional weight of how expensive it is to change this setting between two images (eg loading a model). Defaults to 0 for dry modes, or 1 for non-dry modes.
+    'batchable' is True if images that differ only in this setting (and other batchable settings) can be generated together as a single batch.
     """
-    def __init__(self, dry: bool, type: str, apply: callable, min: float = None, max: float = None, valid_list: callable = None, clean: callable = None, parse_list: callable = None):
+    def __init__(self, dry: bool, type: str, apply: callable, min: float = None, max: float = None, valid_list: callable = None, clean: callable = None, parse_list: callable = None, switch_cost: float = None, batchable: bool = False):
         self.dry = dry
         self.type = type
         self.apply = apply
@@ -172,11 +330,36 @@ class GridSettingMode:
         self.clean = clean
         self.valid_list = valid_list
         self.parse_list = parse_list
+        self.switch_cost = switch_cost if switch_cost is not None else (0 if dry else 1)
+        self.batchable = batchable
 
 def registerMode(name: str, mode: GridSettingMode):
     mode.name = name
     valid_modes[clean_name(name)] = mode
 
+def prompt_replace_parse_list(in_list):
+    if not any(('=' in x) for x in in_list):
+        first_val = in_list[0]
+        for x in range(0, len(in_list)):
+            in_list[x] = {
+                "title": in_list[x],
+                "params": {
+                    "promptreplace": f"{first_val}={in_list[x]}"
+                }
+            }
+    return in_list
+
+def apply_prompt_replace(p, v):
+    val = v.split('=', maxsplit=1)
+    if len(val) != 2:
+        raise RuntimeError(f"Invalid prompt replace, missing '=' symbol, for '{v}'")
+    match = val[0].strip()
+    replace = val[1].strip()
+    if VALIDATE_REPLACE and match not in p.prompt and match not in p.negative_prompt:
+        raise RuntimeError(f"Invalid prompt replace, '{match}' is not in prompt '{p.prompt}' nor negative prompt '{p.negative_prompt}'")
+    p.prompt = p.prompt.replace(match, replace)
+    p.negative_prompt = p.negative_prompt.replace(match, replace)
+
 ######################### Validation #########################
 
 def validate_params(grid, params: dict):
@@ -186,11 +369,12 @@ def validate_params(grid, params: dict):
 def apply_field(name: str):
     def applier(p, v):
         setattr(p, name, v)
+    applier.field_name = name
     return applier
 
 def apply_field_as_image_data(name: str):
     def applier(p, v):
-        file_name = get_best_in_list(v, list_image_files())
+        file_name = get_name_index("images", list_image_files).find(v)
         if file_name is None:
             raise RuntimeError("Invalid parameter '{p}' as '{v}': image file does not exist")
         path = ASSET_DIR + "/images/" + file_name
@@ -236,10 +420,10 @@ def validate_single_param(p: str, v):
         else:
             raise RuntimeError(f"Invalid parameter '{p}' as '{orig_v}': must be either 'true' or 'false'")
     elif mode_type == "text" and mode.valid_list is not None:
-        valid_list = mode.valid_list()
-        v = get_best_in_list(clean_name(v), valid_list)
+        index = get_name_index(f"mode:{p}", mode.valid_list)
+        v = index.find(v)
         if v is None:
-            raise RuntimeError(f"Invalid parameter '{p}' as '{orig_v}': not matched to any entry in list {list(valid_list)}")
+            raise RuntimeError(f"Invalid parameter '{p}' as '{orig_v}': not matched to any entry in list {index.names}")
     if mode.clean is not None:
         return mode.clean(p, v)
     return v
@@ -306,6 +490,15 @@ class AxisValue:
         return self.__str__()
 
 class Axis:
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["mode"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mode = valid_modes.get(clean_mode(self.mode_name)) if hasattr(self, "mode_name") else None
+
     def build_from_list_str(self, id, grid, list_str):
         is_split_by_double_pipe = "||" in list_str
         values_list = list_str.split("||" if is_split_by_double_pipe else ",")
@@ -362,14 +555,52 @@ class Axis:
                     except Exception as e:
                         raise RuntimeError(f"value '{key}' errored: {e}")
 
+def texts_overlap(a: str, b: str):
+    if a in b or b in a:
+        return True
+    return any(a.endswith(b[:x]) or b.endswith(a[:x]) for x in range(1, min(len(a), len(b))))
+
+def variables_need_ordering(variables: dict):
+    """Returns True if replacing every variable in one pass could give a different result than replacing them one at a time in order."""
+    items = list(variables.items())
+    for i, (key, val) in enumerate(items):
+        for later_key, _ in items[i + 1:]:
+            if texts_overlap(key, later_key) or val == "" or texts_overlap(val, later_key):
+                return True
+    return False
+
 class GridFileHelper:
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["compiled_variables", "variable_regex", "variable_memo"]:
+            state.pop(key, None)
+        return state
+
+    def compile_variables(self):
+        self.compiled_variables = self.variables
+        self.variable_memo = dict()
+        self.variable_regex = None
+        if len(self.variables) > 0 and not variables_need_ordering(self.variables):
+            keys = sorted(self.variables.keys(), key=len, reverse=True)
+            self.variable_regex = re.compile("|".join(re.escape(key) for key in keys))
+
     def proc_variables(self, text):
         if text is None:
             return None
         text = str(text)
-        for key, val in self.variables.items():
-            text = text.replace(key, val)
-        return text
+        if getattr(self, "compiled_variables", None) is not self.variables:
+            self.compile_variables()
+        result = self.variable_memo.get(text)
+        if result is not None:
+            return result
+        if self.variable_regex is not None:
+            result = self.variable_regex.sub(lambda match: self.variables[match.group(0)], text)
+        else:
+            result = text
+            for key, val in self.variables.items():
+                result = result.replace(key, val)
+        self.variable_memo[text] = result
+        return result
     
     def read_grid_direct(self, key: str):
         return self.grid_obj.get(key)
@@ -397,6 +628,7 @@ class GridFileHelper:
         self.skip_invalid = self.read_grid_direct("skip_invalid") or getattr(self, 'skip_invalid', False)
         if self.title is None or self.description is None or self.author is None or self.format is None:
             raise RuntimeError(f"Invalid file {grid_file}: missing grid title, author, format, or description in grid obj {self.grid_obj}")
+        self.encode_options = read_encode_options(self)
         self.params = fix_dict(self.grid_obj.get("params"))
         if self.params is not None:
             validate_params(self, self.params)
@@ -417,36 +649,823 @@ class GridFileHelper:
         print(f"Loaded grid file, title '{self.title}', description '{clean_desc}', with {len(self.axes)} axes... combines to {total_count} total images")
         return self
 
+######################### Parse Cache #########################
+
+INCLUDE_REGEX = re.compile(r"""!include\s+(?:"([^"]*)"|'([^']*)'|([^\s,\]}#]+))""")
+
+def get_code_fingerprint(func):
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return None if func is None else getattr(func, "__qualname__", type(func).__name__)
+    return hashlib.sha256(code.co_code + repr(code.co_consts).encode('utf-8')).hexdigest()
+
+def get_modes_fingerprint():
+    modes = list()
+    for name, mode in sorted(valid_modes.items()):
+        try:
+            valid_list = [str(x) for x in mode.valid_list()] if mode.valid_list is not None else None
+        except Exception as e:
+            valid_list = f"error: {e}"
+        modes.append([name, mode.type, mode.min, mode.max, valid_list, get_code_fingerprint(mode.clean), get_code_fingerprint(mode.parse_list)])
+    with open(__file__, 'rb') as f:
+        modes.append(hashlib.sha256(f.read()).hexdigest())
+    return hashlib.sha256(json.dumps(modes, default=str).encode('utf-8')).hexdigest()
+
+def get_include_hashes(path: str, found: dict):
+    """Records the content hash of a file and everything it includes into 'found'. Returns False if an include is missing."""
+    if path in found:
+        return True
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return False
+    found[path] = hashlib.sha256(content).hexdigest()
+    for match in INCLUDE_REGEX.finditer(content.decode('utf-8', errors='replace')):
+        include = next(x for x in match.groups() if x is not None)
+        files = sorted(glob.glob(ASSET_DIR + "/" + include, recursive=True))
+        found[f"glob:{include}"] = files
+        if len(files) == 0:
+            return False
+        for file in files:
+            if not get_include_hashes(os.path.abspath(file), found):
+                return False
+    return True
+
+class GridParseCache:
+    """Cache of parsed grid files, keyed on their content, their includes, the registered modes and the parse options."""
+    def __init__(self, dir: str):
+        self.dir = dir
+
+    def get_key(self, input_file: str, allow_includes: bool, skip_invalid: bool):
+        files = dict()
+        if not get_include_hashes(os.path.abspath(ASSET_DIR + "/" + input_file), files):
+            return None
+        text = json.dumps([files, get_modes_fingerprint(), allow_includes, skip_invalid], sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def path_for(self, input_file: str):
+        return self.dir + "/" + clean_id(input_file) + ".pickle"
+
+    def load(self, input_file: str, key: str):
+        try:
+            with open(self.path_for(input_file), 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return None
+        if data.get("key") != key or any(axis.mode is None for axis in data["grid"].axes):
+            return None
+        return data["grid"], data["yaml_content"]
+
+    def save(self, input_file: str, key: str, grid: GridFileHelper, yaml_content: dict):
+        path = self.path_for(input_file)
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            with open(path + ".tmp", 'wb') as f:
+                pickle.dump({"key": key, "grid": grid, "yaml_content": yaml_content}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"Failed to save grid parse cache for '{input_file}': {e}")
+
+def load_grid_file(input_file: str, allow_includes: bool, skip_invalid: bool, profiler: GridProfiler = None):
+    profiler = profiler or GridProfiler()
+    full_input_path = ASSET_DIR + "/" + input_file
+    if not os.path.exists(full_input_path):
+        raise RuntimeError(f"Non-existent file '{input_file}'")
+    cache = GridParseCache(PARSE_CACHE_DIR) if PARSE_CACHE_DIR is not None else None
+    key = cache.get_key(input_file, allow_includes, skip_invalid) if cache is not None else None
+    if key is not None:
+        with profiler.span("load parse cache"):
+            cached = cache.load(input_file, key)
+        if cached is not None:
+            grid, yaml_content = cached
+            total_count = math.prod(len(axis.values) for axis in grid.axes)
+            print(f"Loaded grid file '{input_file}' from parse cache, title '{grid.title}', with {len(grid.axes)} axes... combines to {total_count} total images")
+            return grid, yaml_content
+    grid = GridFileHelper()
+    grid.stylesheet = ''
+    grid.skip_invalid = skip_invalid
+    # Parse and verify
+    with open(full_input_path, 'r', encoding="utf-8") as yaml_content_text, profiler.span("load yaml"):
+        try:
+            if allow_includes:
+                yaml_content = yaml.load(yaml_content_text, Loader=GridYamlLoader)
+            else:
+                yaml_content = yaml.safe_load(yaml_content_text)
+        except yaml.YAMLError as exc:
+            raise RuntimeError(f"Invalid YAML in file '{input_file}': {exc}")
+    with profiler.span("parse yaml"):
+        grid.parse_yaml(yaml_content, input_file)
+    if key is not None:
+        cache.save(input_file, key, grid, yaml_content)
+    return grid, yaml_content
+
 ######################### Actual Execution Logic #########################
 
+class LayeredParams(Mapping):
+    """Read-only view of the params of a call, resolved through the grid's base params and then each of its axis values."""
+    __slots__ = ('layers',)
+
+    def __init__(self, layers: tuple):
+        self.layers = layers
+
+    def __getitem__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(dict.fromkeys(key for layer in self.layers for key in layer))
+
+    def __len__(self):
+        return len(dict.fromkeys(key for layer in self.layers for key in layer))
+
+    def copy(self):
+        return dict(self.items())
+
 class SingleGridCall:
-    def __init__(self, values: list):
-        self.values = values
-        self.skip = False
-        for val in values:
-            if val.skip:
-                self.skip = True
+    """A single image within the grid, stored as one value index per axis."""
+    __slots__ = ('runner', 'indices', 'skip', 'do_skip', '_params', 'hook_data')
+
+    def __init__(self, runner, indices: tuple):
+        self.runner = runner
+        self.indices = indices
+        self._params = None
+        self.hook_data = None
+        self.skip = any(val.skip for val in self.values)
+        self.do_skip = self.skip
         if grid_call_init_hook is not None:
             grid_call_init_hook(self)
 
-    def flatten_params(self, grid: GridFileHelper):
-        self.grid = grid
-        self.params = grid.params.copy() if grid.params is not None else dict()
+    @property
+    def grid(self):
+        return self.runner.grid
+
+    @property
+    def values(self):
+        return [axis.values[i] for axis, i in zip(self.grid.axes, self.indices)]
+
+    @property
+    def relative_path(self):
+        return '/'.join(val.path for val in self.values)
+
+    @property
+    def filepath(self):
+        return self.runner.base_path + '/' + self.relative_path
+
+    @property
+    def data(self):
+        return ', '.join(f"{val.axis.title}={val.title}" for val in self.values)
+
+    @property
+    def params(self):
+        if self._params is None:
+            self.flatten_params()
+        return self._params
+
+    def flatten_params(self):
+        layers = [self.grid.params if self.grid.params is not None else dict()]
         for val in self.values:
-            for p, v in val.params.items():
-                if grid_call_param_add_hook is None or not grid_call_param_add_hook(self, p, v):
-                    self.params[p] = v
+            layer = val.params
+            if grid_call_param_add_hook is not None:
+                layer = {p: v for p, v in val.params.items() if not grid_call_param_add_hook(self, p, v)}
+                if len(layer) == len(val.params):
+                    layer = val.params
+            layers.append(layer)
+        self._params = LayeredParams(tuple(layers))
+
+    def get_param_hash(self):
+        """Returns a hash of the settings of this call that doesn't depend on the grid's layout, for the image cache and 'rebuild_changed'."""
+        params = dict(self.runner.base_param_data)
+        params.update({clean_mode(p): v for p, v in (self.grid.params or {}).items()})
+        for val in self.values:
+            params.update({clean_mode(p): v for p, v in val.params.items()})
+        text = json.dumps(params, sort_keys=True, default=str)
+        if len(self.runner.extra_state) > 0:
+            text += json.dumps(self.runner.extra_state, sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+    def get_effective_hash(self, p):
+        """Returns a hash of what this call would actually generate, for spotting duplicates within a run, or None if its seed is random."""
+        p = copy(p)
+        raw = dict()
+        for name, val in self.params.items():
+            apply = valid_modes[clean_mode(name)].apply
+            if hasattr(apply, 'field_name'):
+                setattr(p, apply.field_name, val)
+            else:
+                raw[clean_mode(name)] = val
+        if grid_call_apply_hook is not None:
+            grid_call_apply_hook(self, p, True)
+        if getattr(p, 'seed', None) == -1 or raw.get('seed') == -1:
+            return None
+        if getattr(p, 'subseed', None) == -1 and getattr(p, 'subseed_strength', 0):
+            return None
+        fields = {name: getattr(p, name, None) for name in self.runner.get_effective_fields()}
+        text = json.dumps([fields, raw], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).digest()
 
     def apply_to(self, p, dry: bool):
         for name, val in self.params.items():
             mode = valid_modes[clean_mode(name)]
             if not dry or mode.dry:
-                mode.apply(p, val)
+                if mode.switch_cost > 0:
+                    # Expensive settings (like model loads) get their own span, to show how much time goes into switching them
+                    with self.runner.profiler.span(f"apply {mode.name}", "cell", value=str(val)):
+                        mode.apply(p, val)
+                else:
+                    mode.apply(p, val)
         if grid_call_apply_hook is not None:
             grid_call_apply_hook(self, p, dry)
 
+class OutputFileIndex:
+    """Tracks which output files exist, with one cached os.scandir per directory instead of a stat per image."""
+    def __init__(self):
+        self.dirs = {}
+
+    def list_dir(self, dir: str):
+        names = self.dirs.get(dir)
+        if names is None:
+            names = set()
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            names.add(entry.name)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self.dirs[dir] = names
+        return names
+
+    def exists(self, path: str):
+        dir, name = os.path.split(path)
+        return name in self.list_dir(dir)
+
+class ParamHashLog:
+    """Append-only log of the param hash each image was made with, compacted at the end of a run."""
+    def __init__(self, path: str):
+        self.path = path
+        self.hashes = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip('\n').split(' ', maxsplit=1)
+                    if len(parts) == 2:
+                        self.hashes[parts[1]] = parts[0]
+
+    def get(self, name: str):
+        return self.hashes.get(name)
+
+    def record(self, name: str, hash: str):
+        self.hashes[name] = hash
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a', encoding="utf-8") as f:
+            f.write(f"{hash} {name}\n")
+
+    def compact(self):
+        if not os.path.exists(self.path):
+            return
+        self.write()
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", 'w', encoding="utf-8") as f:
+            for name, hash in self.hashes.items():
+                f.write(f"{hash} {name}\n")
+        os.replace(self.path + ".tmp", self.path)
+
+def get_file_checksum(path: str):
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            hasher.update(chunk)
+    return size, hasher.hexdigest()
+
+class RunJournal:
+    """Append-only log of each image going from 'queued' to 'generated' to 'saved', for resuming interrupted runs."""
+    STATES = ["queued", "generated", "saved"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cells = dict()
+        self.touched = set()
+        self.file = None
+        if os.path.exists(path):
+            with open(path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip('\n').split(' ', maxsplit=3)
+                    if line.endswith('\n') and len(parts) == 4 and parts[0] in RunJournal.STATES:
+                        self.cells[parts[3]] = tuple(parts[:3])
+
+    def state(self, name: str):
+        entry = self.cells.get(name)
+        return None if entry is None else entry[0]
+
+    def record(self, name: str, state: str, size: str = "-", checksum: str = "-"):
+        with self.lock:
+            # Inline saves report the image as saved before generation is marked done, so never step an image saved during this run back to 'generated'
+            if state == "generated" and name in self.touched and self.state(name) == "saved":
+                return
+            self.cells[name] = (state, str(size), checksum)
+            self.touched.add(name)
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a', encoding="utf-8")
+            self.file.write(f"{state} {size} {checksum} {name}\n")
+            self.file.flush()
+
+    def record_saved(self, name: str, path: str):
+        try:
+            size, checksum = get_file_checksum(path)
+        except OSError as e:
+            print(f"Failed to checksum saved image {path}: {e}")
+            return
+        self.record(name, "saved", size, checksum)
+
+    def get_unsaved(self, touched_only: bool = False):
+        with self.lock:
+            return [name for name, (state, _, _) in self.cells.items() if state != "saved" and (not touched_only or name in self.touched)]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def compact(self):
+        self.close()
+        with self.lock:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path + ".tmp", 'w', encoding="utf-8") as f:
+                for name, (state, size, checksum) in self.cells.items():
+                    f.write(f"{state} {size} {checksum} {name}\n")
+            os.replace(self.path + ".tmp", self.path)
+
+def read_image_parameters(path: str):
+    """Returns the generation info embedded in an image file, or None, reading only its header."""
+    try:
+        with Image.open(path) as img:
+            if isinstance(img.info.get("parameters"), str):
+                return img.info["parameters"]
+            comment = img.getexif().get_ifd(0x8769).get(0x9286)
+    except (OSError, SyntaxError):
+        return None
+    if isinstance(comment, bytes) and comment.startswith(b"UNICODE\0"):
+        return comment[8:].decode("utf-16-be", errors="replace")
+    return None
+
+def link_or_copy_file(source: str, target: str):
+    temp = target + ".linktmp"
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copyfile(source, temp)
+    os.replace(temp, target)
+
+class ImageCache:
+    """Store of generated images shared between grids, keyed by param hash and format, that drops the least recently used past its size limit."""
+    def __init__(self, dir: str, max_size_mb: float = 10240):
+        self.dir = dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.total_hits = 0
+        self.total_misses = 0
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(dir + "/index.json"):
+            with open(dir + "/index.json", 'r', encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+            self.total_hits = data.get('hits', 0)
+            self.total_misses = data.get('misses', 0)
+        self.size = sum(entry[0] for entry in self.entries.values())
+
+    def path_for(self, key: str):
+        return f"{self.dir}/{key[:2]}/{key}"
+
+    def fetch(self, hash: str, ext: str, target: str):
+        key = f"{hash}.{ext}"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                try:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    link_or_copy_file(self.path_for(key), target)
+                    entry[1] = time.time()
+                    self.hits += 1
+                    return True
+                except FileNotFoundError:
+                    self.size -= entry[0]
+                    del self.entries[key]
+            self.misses += 1
+            return False
+
+    def store(self, hash: str, ext: str, source: str):
+        key = f"{hash}.{ext}"
+        with self.lock:
+            path = self.path_for(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            link_or_copy_file(source, path)
+            if key in self.entries:
+                self.size -= self.entries[key][0]
+            size = os.path.getsize(path)
+            self.entries[key] = [size, time.time()]
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        if self.size <= self.max_size:
+            return
+        for key, entry in sorted(self.entries.items(), key=lambda e: e[1][1]):
+            try:
+                os.remove(self.path_for(key))
+            except FileNotFoundError:
+                pass
+            self.size -= entry[0]
+            del self.entries[key]
+            if self.size <= self.max_size:
+                break
+
+    def stats(self):
+        def rate(hits, misses):
+            return 0 if hits + misses == 0 else hits / (hits + misses)
+        total_hits = self.total_hits + self.hits
+        total_misses = self.total_misses + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': rate(self.hits, self.misses),
+            'total_hits': total_hits,
+            'total_misses': total_misses,
+            'total_hit_rate': rate(total_hits, total_misses),
+            'entries': len(self.entries),
+            'size_mb': self.size / (1024 * 1024)
+        }
+
+    def save(self):
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            with open(self.dir + "/index.json.tmp", 'w', encoding="utf-8") as f:
+                json.dump({'hits': self.total_hits + self.hits, 'misses': self.total_misses + self.misses, 'entries': self.entries}, f)
+            os.replace(self.dir + "/index.json.tmp", self.dir + "/index.json")
+
+def get_save_args(ext: str, options: dict, quality_key: str = "quality"):
+    ext = ext.lower()
+    args = dict()
+    quality = options.get(quality_key)
+    if ext == "png":
+        if options.get("compression") is not None:
+            args["compress_level"] = options["compression"]
+        if options.get("optimize"):
+            args["optimize"] = True
+    elif ext in ["jpg", "jpeg"]:
+        if quality is not None:
+            args["quality"] = quality
+        if options.get("optimize"):
+            args["optimize"] = True
+    elif ext == "webp":
+        if quality is not None:
+            args["quality"] = quality
+        if options.get("optimize"):
+            args["method"] = 6
+            if quality is None:
+                args["lossless"] = True
+    return args
+
+def get_image_format(ext: str):
+    return Image.registered_extensions().get("." + ext.lower(), ext.upper())
+
+def read_encode_options(grid):
+    options = dict()
+    def read_int(key: str, min: int, max: int):
+        val = grid.read_str_from_grid(key)
+        if val is None:
+            return
+        try:
+            options[key] = int(val)
+        except ValueError:
+            raise RuntimeError(f"Invalid grid setting '{key}' as '{val}': must be an integer number")
+        if options[key] < min or options[key] > max:
+            raise RuntimeError(f"Invalid grid setting '{key}' as '{val}': must be between {min} and {max}")
+    read_int("quality", 1, 100)
+    read_int("compression", 0, 9)
+    read_int("secondary quality", 1, 100)
+    if str(grid.read_str_from_grid("optimize")).lower() == "true":
+        options["optimize"] = True
+    secondary = grid.read_str_from_grid("secondary format")
+    if secondary is not None and secondary.strip().lower() not in ["", "none"]:
+        secondary = secondary.strip().lower()
+        if secondary == grid.format.lower() or ("." + secondary) not in Image.registered_extensions():
+            raise RuntimeError(f"Invalid grid setting 'secondary format' as '{secondary}': must be an image format other than the main format")
+        options["secondary format"] = secondary
+    return options
+
+def write_thumbnails(img, thumbnails: list):
+    """Writes a downscaled WebP copy of an image for each (width, path) pair."""
+    for width, path in thumbnails:
+        thumb = img if img.mode in ["RGB", "RGBA"] else img.convert("RGB")
+        if thumb.width > width:
+            thumb = thumb.resize((width, max(1, round(thumb.height * width / thumb.width))), resample=Image.LANCZOS)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        thumb.save(path + ".tmp", format="WEBP", quality=80)
+        os.replace(path + ".tmp", path)
+
+def make_thumbnail_files(path: str, thumbnails: list):
+    with Image.open(path) as img:
+        img.load()
+    write_thumbnails(img, thumbnails)
+
+def write_derived_files(img, base: str, info: dict, options: dict, thumbnails: list = None):
+    """Writes the thumbnails and secondary format copy of an image beside 'base', its path without extension."""
+    if thumbnails:
+        write_thumbnails(img, thumbnails)
+    secondary = options.get("secondary format")
+    if secondary is not None:
+        out = img.convert("RGB") if secondary in ["jpg", "jpeg"] and img.mode not in ["RGB", "L"] else img
+        temp = f"{base}.tmp.{secondary}"
+        out.save(temp, format=get_image_format(secondary), **get_save_args(secondary, options, "secondary quality"), **get_metadata_args(info, secondary))
+        os.replace(temp, f"{base}.{secondary}")
+
+def encode_image_file(path: str, ext: str, options: dict, reoptimize: bool = True, thumbnails: list = None):
+    """Applies encode options to a saved image: re-encodes lossless formats in place, and writes its thumbnails and secondary format."""
+    with Image.open(path) as img:
+        img.load()
+    info = dict(img.info)
+    base = path[:-len(ext) - 1]
+    if reoptimize and ext.lower() == "png" and len(get_save_args(ext, options)) > 0:
+        temp = f"{base}.tmp.{ext}"
+        img.save(temp, format=get_image_format(ext), **get_save_args(ext, options), **get_metadata_args(info, ext))
+        os.replace(temp, path)
+    write_derived_files(img, base, info, options, thumbnails)
+
+def get_metadata_args(info: dict, ext: str):
+    """Returns the PIL save arguments that embed 'info' (eg {'parameters': infotext}) in the given format."""
+    args = dict()
+    if ext.lower() == "png":
+        pnginfo = PngImagePlugin.PngInfo()
+        for key, val in info.items():
+            if isinstance(val, str):
+                pnginfo.add_text(key, val)
+        args["pnginfo"] = pnginfo
+    if "exif" in info:
+        args["exif"] = info["exif"]
+    elif "parameters" in info and ext.lower() != "png":
+        exif = Image.Exif()
+        exif.get_ifd(0x8769)[0x9286] = b"UNICODE\0" + info["parameters"].encode("utf-16-be")
+        args["exif"] = exif.tobytes()
+    return args
+
+def save_image_file(img, path: str, ext: str, info: str = None, options: dict = None, thumbnails: list = None):
+    """Saves an image with its generation info and encode options, along with its thumbnails and secondary format copy."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if img.mode not in ["RGB", "L"] and ext in ["jpg", "jpeg"]:
+        img = img.convert("RGB")
+    metadata = {"parameters": info} if info is not None else {}
+    base = path[:-len(ext) - 1]
+    img.save(f"{base}.tmp.{ext}", format=get_image_format(ext), **get_save_args(ext, options or {}), **get_metadata_args(metadata, ext))
+    os.replace(f"{base}.tmp.{ext}", path)
+    write_derived_files(img, base, metadata, options or {}, thumbnails)
+
+def timed_call(func: callable, *args):
+    # perf_counter is system-wide on all supported platforms, so times from worker processes line up with the main process
+    start = time.perf_counter()
+    func(*args)
+    return start, time.perf_counter(), os.getpid(), threading.get_ident()
+
+class ImageSaveQueue:
+    """Bounded pool of background image savers: 'submit' blocks once 'max_pending' are waiting, and 'drain' waits for all of them."""
+    def __init__(self, workers: int = 2, max_pending: int = None, use_processes: bool = False, profiler: GridProfiler = None, name: str = "save"):
+        self.use_processes = use_processes
+        self.profiler = profiler
+        self.name = name
+        self.executor = ProcessPoolExecutor(workers) if use_processes else ThreadPoolExecutor(workers, thread_name_prefix="infinity_grid_save")
+        self.slots = threading.BoundedSemaphore(max_pending or workers * 2)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.encode_time = 0
+        self.wait_time = 0
+
+    def submit(self, func: callable, *args, on_done: callable = None):
+        """Queues 'func(*args)' on a worker, then 'on_done()' if it succeeded."""
+        start = time.perf_counter()
+        self.slots.acquire()
+        with self.lock:
+            self.wait_time += time.perf_counter() - start
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        try:
+            future = self.executor.submit(timed_call, func, *args)
+        except BaseException:
+            # Nothing will finish this save, so give back its slot or 'drain' would wait forever
+            with self.lock:
+                self.depth -= 1
+                self.idle.notify_all()
+            self.slots.release()
+            raise
+        def finished(future):
+            try:
+                start, end, pid, tid = future.result()
+                if self.profiler is not None:
+                    self.profiler.add(self.name, "io", start, end, pid=pid, tid=tid, thread_name=f"{self.name} worker")
+                with self.lock:
+                    self.encode_time += end - start
+                    self.completed += 1
+                if on_done is not None:
+                    on_done()
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                print(f"Failed to save image: {e}")
+            finally:
+                with self.lock:
+                    self.depth -= 1
+                    self.idle.notify_all()
+                self.slots.release()
+        future.add_done_callback(finished)
+
+    def drain(self):
+        with self.idle:
+            while self.depth > 0:
+                self.idle.wait()
+
+    def shutdown(self):
+        self.drain()
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'completed': self.completed,
+                'failed': self.failed,
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'encode_seconds': self.encode_time,
+                'wait_seconds': self.wait_time
+            }
+
+class LiveUpdateLog:
+    """Numbered log of saved images, split into segment files, that the web viewer polls while a grid is running."""
+    def __init__(self, dir: str, segment_size: int = 200):
+        self.dir = dir
+        self.segment_size = segment_size
+        self.seq = 0
+
+    def reset(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir, exist_ok=True)
+        open(self.dir + "/0.js", 'w', encoding="utf-8").close()
+        self.seq = 0
+
+    def append(self, path: str):
+        segment = self.seq // self.segment_size
+        os.makedirs(self.dir, exist_ok=True)
+        with open(f"{self.dir}/{segment}.js", 'a', encoding="utf-8") as f:
+            f.write(f"liveUpdate({self.seq}, {json.dumps(path)});\n")
+            self.seq += 1
+            if self.seq % self.segment_size == 0:
+                # The next segment exists before the viewer is pointed at it, so it never polls a missing file
+                open(f"{self.dir}/{segment + 1}.js", 'a', encoding="utf-8").close()
+                f.write(f"liveUpdateNext({segment + 1});\n")
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def get_metadata_shard_depth(grid, max_shard_size: int = 1000):
+    """Returns how many leading axes to shard metadata by, for at most 'max_shard_size' images per shard."""
+    depth = 0
+    while depth < len(grid.axes) and math.prod(len(axis.values) for axis in grid.axes[depth:]) > max_shard_size:
+        depth += 1
+    return depth
+
+class MetadataIndex:
+    """Generation metadata for the web viewer, as 'gridMeta(path, data);' lines in shard scripts under 'meta/'."""
+    def __init__(self, dir: str, depth: int):
+        self.dir = dir
+        self.depth = depth
+        self.touched = set()
+        self.known_shard = None
+        self.known_images = set()
+
+    def shard_for(self, relative_path: str):
+        return '/'.join(relative_path.split('/')[:self.depth]) or "index"
+
+    def reshard(self):
+        """Moves the entries of shards written with a different depth into shards of the current depth."""
+        depth_path = self.dir + "/depth.txt"
+        old_depth = None
+        if os.path.exists(depth_path):
+            with open(depth_path, 'r', encoding="utf-8") as f:
+                old_depth = f.read().strip()
+        if old_depth != str(self.depth) and os.path.isdir(self.dir):
+            entries = dict()
+            for path in glob.glob(glob.escape(self.dir) + "/**/*.js", recursive=True):
+                entries.update(MetadataIndex.read_entries(path)[0])
+            shutil.rmtree(self.dir)
+            shards = dict()
+            for image, data in entries.items():
+                shards.setdefault(self.shard_for(image), dict())[image] = data
+            for shard, shard_entries in shards.items():
+                MetadataIndex.write_entries(f"{self.dir}/{shard}.js", shard_entries)
+            if len(entries) > 0:
+                print(f"Moved metadata for {len(entries)} images into shards by {self.depth} axes")
+        os.makedirs(self.dir, exist_ok=True)
+        with open(depth_path, 'w', encoding="utf-8") as f:
+            f.write(str(self.depth))
+
+    def has(self, relative_path: str):
+        shard = self.shard_for(relative_path)
+        if shard != self.known_shard:
+            path = f"{self.dir}/{shard}.js"
+            self.known_shard = shard
+            self.known_images = set(MetadataIndex.read_entries(path)[0].keys()) if os.path.exists(path) else set()
+        return relative_path in self.known_images
+
+    def add(self, relative_path: str, data: dict):
+        path = f"{self.dir}/{self.shard_for(relative_path)}.js"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding="utf-8") as f:
+            f.write(f"gridMeta({json.dumps(relative_path)}, {json.dumps(data, default=str)});\n")
+        self.touched.add(path)
+
+    @staticmethod
+    def read_entries(path: str):
+        prefix = len("gridMeta(")
+        entries = dict()
+        with open(path, 'r', encoding="utf-8") as f:
+            lines = f.readlines()
+        for line in lines:
+            try:
+                image, data = json.loads("[" + line.strip()[prefix:-2] + "]")
+            except ValueError:
+                continue
+            entries[image] = data
+        return entries, len(lines)
+
+    @staticmethod
+    def write_entries(path: str, entries: dict):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w', encoding="utf-8") as f:
+            for image, data in entries.items():
+                f.write(f"gridMeta({json.dumps(image)}, {json.dumps(data)});\n")
+        os.replace(path + ".tmp", path)
+
+    def compact(self):
+        for path in self.touched:
+            entries, line_count = MetadataIndex.read_entries(path)
+            if len(entries) == line_count:
+                continue
+            MetadataIndex.write_entries(path, entries)
+
+class GridShard:
+    """One of 'count' disjoint parts of a grid (numbered from 1), picked by a hash of each cell's path or as a range of the run order."""
+    MODES = ["hash", "range"]
+
+    def __init__(self, index: int, count: int, mode: str = "hash"):
+        if count < 1 or index < 1 or index > count:
+            raise RuntimeError(f"Invalid shard {index}/{count}: must be a number from 1 to the shard count")
+        if mode not in GridShard.MODES:
+            raise RuntimeError(f"Invalid shard mode '{mode}': must be one of {', '.join(GridShard.MODES)}")
+        self.index = index
+        self.count = count
+        self.mode = mode
+
+    @staticmethod
+    def parse(spec: str, mode: str = "hash"):
+        parts = spec.split('/')
+        try:
+            if len(parts) != 2:
+                raise ValueError()
+            return GridShard(int(parts[0]), int(parts[1]), mode)
+        except ValueError:
+            raise RuntimeError(f"Invalid shard '{spec}': must be in the form 'index/count', like '2/4'")
+
+    def contains(self, set, position: int, total: int):
+        if self.mode == "range":
+            return position * self.count // total == self.index - 1
+        return int(hashlib.sha256(set.relative_path.encode('utf-8')).hexdigest()[:16], 16) % self.count == self.index - 1
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    @property
+    def manifest_name(self):
+        return f"shard_{self.index}_of_{self.count}.json"
+
 class GridRunner:
-    def __init__(self, grid: GridFileHelper, do_overwrite: bool, base_path: str, p, fast_skip: bool):
+    def __init__(self, grid: GridFileHelper, do_overwrite: bool, base_path: str, p, fast_skip: bool, batch_size: int = 1, rebuild_changed: bool = False):
         self.grid = grid
         self.total_run = 0
         self.total_skip = 0
@@ -454,86 +1473,367 @@ class GridRunner:
         self.do_overwrite = do_overwrite
         self.base_path = base_path
         self.fast_skip = fast_skip
+        self.batch_size = max(1, batch_size) if grid_runner_post_dry_batch_hook is not None else 1
+        self.rebuild_changed = rebuild_changed
+        self.existing_files = OutputFileIndex()
+        self.param_hashes = ParamHashLog(base_path + "/param_hashes.txt")
+        self.journal = RunJournal(base_path + "/journal.log")
+        self.profiler = GridProfiler()
+        self.total_repair = 0
+        self.base_param_data = (webdata_get_base_param_data(p) if webdata_get_base_param_data is not None else None) or dict()
+        self.extra_state = dict()
+        self.unhashable_state = None
+        if grid_runner_get_extra_state is not None:
+            try:
+                self.extra_state = get_state_data(grid_runner_get_extra_state(p) or dict())
+            except UnhashableState as e:
+                self.unhashable_state = str(e)
+        self.image_cache = None
+        self.save_queue = None
+        self.encode_queue = None
+        self.metadata_index = None
+        self.thumbnail_widths = []
+        self.dispatcher = None
+        self.shard = None
+        self.lock = threading.Lock()
+        self.generated_by_hash = OrderedDict()
+        self.effective_fields = None
+        self.duplicates = dict()
+        self.pending_originals = set()
         self.p = p
         grid.min_width = None
         grid.min_height = None
         grid.initial_p = p
-        self.last_update = []
-
-    def update_live_file(self, new_file: str):
-        t_now = time.time()
-        self.last_update = [x for x in self.last_update if t_now - x['t'] < 20]
-        self.last_update.append({'f': new_file, 't': t_now})
-        with open(self.base_path + '/last.js', 'w', encoding="utf-8") as f:
-            update_str = '", "'.join([x['f'] for x in self.last_update])
-            f.write(f'window.lastUpdated = ["{update_str}"]')
-
-    def build_value_set_list(self, axis_list: list):
-        result = list()
-        if len(axis_list) == 0:
-            return result
-        cur_axis = axis_list[0]
-        if len(axis_list) == 1:
-            for val in cur_axis.values:
-                if not val.skip or not self.fast_skip:
-                    new_list = list()
-                    new_list.append(val)
-                    result.append(SingleGridCall(new_list))
-            return result
-        next_axis_list = axis_list[1::]
-        for obj in self.build_value_set_list(next_axis_list):
-            for val in cur_axis.values:
-                if not val.skip or not self.fast_skip:
-                    new_list = obj.values.copy()
-                    new_list.append(val)
-                    result.append(SingleGridCall(new_list))
-        return result
+        self.live_log = LiveUpdateLog(base_path + "/live")
+
+    def get_axis_value_lists(self):
+        return [[i for i, val in enumerate(axis.values) if not val.skip or not self.fast_skip] for axis in self.grid.axes]
+
+    def count_value_sets(self):
+        if len(self.grid.axes) == 0:
+            return 0
+        return math.prod(len(values) for values in self.get_axis_value_lists())
+
+    def iterate_value_sets(self):
+        """Lazily yields the calls of the grid (or of this shard), in the order from 'get_run_axis_order'."""
+        value_lists = self.get_axis_value_lists()
+        if len(value_lists) == 0 or any(len(values) == 0 for values in value_lists):
+            return
+        order = self.get_run_axis_order()
+        counter = [0] * len(value_lists)
+        total = math.prod(len(values) for values in value_lists)
+        position = 0
+        while True:
+            set = SingleGridCall(self, tuple(values[i] for values, i in zip(value_lists, counter)))
+            if self.shard is None or self.shard.contains(set, position, total):
+                yield self.prepare_call(set)
+            position += 1
+            for digit in reversed(order):
+                counter[digit] += 1
+                if counter[digit] < len(value_lists[digit]):
+                    break
+                counter[digit] = 0
+            else:
+                return
+
+    def get_run_axis_order(self):
+        """Returns the axis indices outermost first: expensive axes (like the model) first, and when batching, axes that only change batchable settings last."""
+        def get_cost(axis):
+            return max((valid_modes[clean_mode(p)].switch_cost for val in axis.values for p in val.params.keys() if clean_mode(p) in valid_modes), default=0)
+        def is_batchable(axis):
+            return all(clean_mode(p) in valid_modes and valid_modes[clean_mode(p)].batchable for val in axis.values for p in val.params.keys())
+        costs = [get_cost(axis) for axis in self.grid.axes]
+        inner = [self.batch_size > 1 and costs[i] == 0 and is_batchable(axis) for i, axis in enumerate(self.grid.axes)]
+        return sorted(range(len(self.grid.axes)), key=lambda i: (-costs[i], inner[i]))
+
+    def prepare_call(self, set):
+        set.flatten_params()
+        set.do_skip = set.skip or (not self.do_overwrite and self.output_exists(set))
+        if set.do_skip and not set.skip and self.rebuild_changed:
+            set.do_skip = self.param_hashes.get(set.relative_path) == set.get_param_hash()
+        return set
+
+    def output_exists(self, set):
+        """Returns whether the image of a call exists and, if the journal has it, was fully saved."""
+        state = self.journal.state(set.relative_path)
+        if state is not None and state != "saved":
+            return False
+        return self.existing_files.exists(set.filepath + "." + self.grid.format)
+
+    def get_batch_key(self, set):
+        """Returns the non-batchable params of a call. Only calls with equal keys can share a batch."""
+        params = ((clean_mode(p), v) for p, v in set.params.items())
+        return tuple(sorted((name, str(val)) for name, val in params if not valid_modes[name].batchable))
+
+    def iterate_pending(self, dry: bool):
+        for set in self.iterate_value_sets():
+            if not set.do_skip:
+                yield set
 
     def preprocess(self):
-        self.value_sets = self.build_value_set_list(list(reversed(self.grid.axes)))
-        print(f'Have {len(self.value_sets)} unique value sets, will go into {self.base_path}')
-        for set in self.value_sets:
-            set.filepath = self.base_path + '/' + '/'.join(list(map(lambda v: v.path, set.values)))
-            set.data = ', '.join(list(map(lambda v: f"{v.axis.title}={v.title}", set.values)))
-            set.flatten_params(self.grid)
-            set.do_skip = set.skip or (not self.do_overwrite and os.path.exists(set.filepath + "." + self.grid.format))
+        print(f'Have {self.count_value_sets()} unique value sets, will go into {self.base_path}')
+        if self.shard is not None:
+            print(f"Running only shard {self.shard} (by {self.shard.mode}) of the grid")
+        catch_up = 0
+        for set in self.iterate_value_sets():
             if set.do_skip:
                 self.total_skip += 1
+                if not set.skip and len(self.thumbnail_widths) > 0 and self.catch_up_thumbnails(set):
+                    catch_up += 1
+                if not set.skip and self.metadata_index is not None and not self.metadata_index.has(set.relative_path):
+                    self.add_file_metadata(set)
             else:
                 self.total_run += 1
                 self.total_steps += grid_runner_count_steps(self, set) if grid_runner_count_steps is not None else 1
+                if self.journal.state(set.relative_path) in ["queued", "generated"]:
+                    self.total_repair += 1
+                    for temp in glob.glob(glob.escape(set.filepath) + ".tmp.*"):
+                        os.remove(temp)
         print(f"Skipped {self.total_skip} files, will run {self.total_run} files, for {self.total_steps} total steps")
+        if self.total_repair > 0:
+            print(f"Repairing {self.total_repair} files that a previous run never finished saving")
+        if catch_up > 0:
+            print(f"Making thumbnails for {catch_up} existing images")
+
+    def write_shard_manifest(self):
+        fingerprint = None
+        if os.path.exists(self.base_path + "/data.js"):
+            with open(self.base_path + "/data.js", 'rb') as f:
+                fingerprint = hashlib.sha256(f.read()).hexdigest()
+        manifest = {
+            'shard': self.shard.index,
+            'count': self.shard.count,
+            'mode': self.shard.mode,
+            'total_cells': self.count_value_sets(),
+            'fingerprint': fingerprint,
+            'format': self.grid.format,
+            'secondary_format': self.grid.encode_options.get("secondary format"),
+            'thumbnail_widths': self.thumbnail_widths,
+            'cells': {set.relative_path: ("skip" if set.skip else "image") for set in self.iterate_value_sets()}
+        }
+        path = f"{self.base_path}/{self.shard.manifest_name}"
+        with open(path + ".tmp", 'w', encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+        print(f"Shard manifest is now at {path}")
+
+    def mark_done(self, set):
+        self.journal.record(set.relative_path, "generated")
+        with self.lock:
+            self.param_hashes.record(set.relative_path, set.get_param_hash())
+
+    def add_image_metadata(self, set, data: dict):
+        """Publishes generation metadata (eg {'parameters': infotext}) for the image of a call, if enabled."""
+        if self.metadata_index is None:
+            return
+        with self.lock:
+            self.metadata_index.add(set.relative_path, data)
+
+    def add_file_metadata(self, set):
+        """Publishes the info embedded in the image file of a call, for images that didn't come through a save hook."""
+        if self.metadata_index is None:
+            return
+        info = read_image_parameters(set.filepath + "." + self.grid.format)
+        if info is not None:
+            self.add_image_metadata(set, {'parameters': info})
+
+    def fetch_cached(self, set):
+        if not self.image_cache.fetch(set.get_param_hash(), self.grid.format, set.filepath + "." + self.grid.format):
+            return False
+        self.add_file_metadata(set)
+        self.mark_done(set)
+        if "secondary format" in self.grid.encode_options or len(self.thumbnail_widths) > 0:
+            self.encode(set, False, lambda: self.mark_saved(set))
+        else:
+            self.mark_saved(set)
+        return True
+
+    def get_effective_fields(self):
+        """Returns the pass-through fields that can differ between calls: the prompts, the seeds, and every field a grid param sets."""
+        if self.effective_fields is None:
+            fields = {"prompt", "negative_prompt", "seed", "subseed", "subseed_strength"}
+            for params in [self.grid.params or {}] + [val.params for axis in self.grid.axes for val in axis.values]:
+                for name in params.keys():
+                    apply = valid_modes[clean_mode(name)].apply
+                    if hasattr(apply, 'field_name'):
+                        fields.add(apply.field_name)
+            self.effective_fields = sorted(fields)
+        return self.effective_fields
+
+    def remember_generated(self, effective_hash: bytes, set):
+        with self.lock:
+            self.pending_originals.add(set.relative_path)
+            self.generated_by_hash[effective_hash] = set.relative_path
+            if len(self.generated_by_hash) > DEDUPLICATE_WINDOW:
+                self.generated_by_hash.popitem(last=False)
+
+    def add_duplicate(self, set, original: str):
+        with self.lock:
+            if original in self.pending_originals:
+                self.duplicates.setdefault(original, list()).append(set)
+                return
+        self.link_duplicate(set, original)
+
+    def link_duplicate(self, set, original: str):
+        ext = "." + self.grid.format
+        original_filepath = self.base_path + '/' + original
+        os.makedirs(os.path.dirname(set.filepath), exist_ok=True)
+        link_or_copy_file(original_filepath + ext, set.filepath + ext)
+        secondary = self.grid.encode_options.get("secondary format")
+        if secondary is not None and os.path.exists(f"{original_filepath}.{secondary}"):
+            link_or_copy_file(f"{original_filepath}.{secondary}", f"{set.filepath}.{secondary}")
+        for (_, source), (_, target) in zip(self.get_thumbnail_paths_at(original), self.get_thumbnail_paths(set)):
+            if os.path.exists(source):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                link_or_copy_file(source, target)
+        self.add_file_metadata(set)
+        self.mark_done(set)
+        self.mark_saved(set)
+
+    def mark_saved(self, set):
+        self.journal.record_saved(set.relative_path, set.filepath + "." + self.grid.format)
+        with self.lock:
+            # Only announced to the viewer once the file is on disk, as it doesn't retry an image that fails to load
+            self.live_log.append(set.relative_path + "." + self.grid.format)
+            self.pending_originals.discard(set.relative_path)
+            duplicates = self.duplicates.pop(set.relative_path, [])
+        for duplicate in duplicates:
+            self.link_duplicate(duplicate, set.relative_path)
+
+    def link_remaining_duplicates(self):
+        with self.lock:
+            remaining = self.duplicates
+            self.duplicates = dict()
+        for original, duplicates in remaining.items():
+            if os.path.exists(f"{self.base_path}/{original}.{self.grid.format}"):
+                for duplicate in duplicates:
+                    self.link_duplicate(duplicate, original)
+
+    def record_unreported_saves(self):
+        """Journals the images that finished saving without an on_image_saved call."""
+        for name in self.journal.get_unsaved(touched_only=True):
+            path = f"{self.base_path}/{name}.{self.grid.format}"
+            if os.path.exists(path):
+                self.journal.record_saved(name, path)
+
+    def get_thumbnail_paths(self, set):
+        return self.get_thumbnail_paths_at(set.relative_path)
+
+    def get_thumbnail_paths_at(self, relative_path: str):
+        return [(width, f"{self.base_path}/thumbs/{width}/{relative_path}.webp") for width in self.thumbnail_widths]
+
+    def catch_up_thumbnails(self, set):
+        """Queues missing thumbnails for an existing image. Returns whether any were missing."""
+        thumbnails = [(width, thumb) for width, thumb in self.get_thumbnail_paths(set) if not self.existing_files.exists(thumb)]
+        if len(thumbnails) == 0:
+            return False
+        path = set.filepath + "." + self.grid.format
+        if self.encode_queue is not None:
+            self.encode_queue.submit(make_thumbnail_files, path, thumbnails)
+        else:
+            make_thumbnail_files(path, thumbnails)
+        return True
+
+    def encode(self, set, reoptimize: bool, on_done: callable):
+        args = (set.filepath + "." + self.grid.format, self.grid.format, self.grid.encode_options, reoptimize, self.get_thumbnail_paths(set))
+        if self.encode_queue is not None:
+            self.encode_queue.submit(encode_image_file, *args, on_done=on_done)
+            return
+        try:
+            encode_image_file(*args)
+        except Exception as e:
+            print(f"Failed to encode image {args[0]}: {e}")
+        on_done()
+
+    def on_image_saved(self, set, encoded: bool = False):
+        """Called from any thread once the image of a call is written. 'encoded' means its encode options, thumbnails and secondary format are already done."""
+        if encoded or (len(self.grid.encode_options) == 0 and len(self.thumbnail_widths) == 0):
+            self.on_image_ready(set)
+        else:
+            self.encode(set, not encoded, lambda: self.on_image_ready(set))
+
+    def on_image_ready(self, set):
+        if self.image_cache is not None:
+            self.image_cache.store(set.get_param_hash(), self.grid.format, set.filepath + "." + self.grid.format)
+        self.mark_saved(set)
+
+    def unlink_cached_outputs(self, batch: list):
+        for _, set in batch:
+            # Don't write into a file that is hardlinked from the image cache
+            path = set.filepath + "." + self.grid.format
+            if self.existing_files.exists(path) and os.stat(path).st_nlink > 1:
+                os.remove(path)
+
+    def run_batch(self, batch: list):
+        self.unlink_cached_outputs(batch)
+        try:
+            with self.profiler.span("generate", "cell", cells=[set.relative_path for _, set in batch]):
+                if len(batch) == 1:
+                    p, set = batch[0]
+                    last = grid_runner_post_dry_hook(self, p, set)
+                else:
+                    last = grid_runner_post_dry_batch_hook(self, batch)
+        except FileNotFoundError as e:
+            if e.strerror == 'The filename or extension is too long' and hasattr(e, 'winerror') and e.winerror == 206:
+                print(f"\n\n\nOS Error: {e.strerror} - see this article to fix that: https://www.autodesk.com/support/technical/article/caas/sfdcarticles/sfdcarticles/The-Windows-10-default-path-length-limitation-MAX-PATH-is-256-characters.html \n\n\n")
+            raise e
+        for _, set in batch:
+            self.mark_done(set)
+        return last
 
     def run(self, dry: bool):
         if grid_runner_pre_run_hook is not None:
             grid_runner_pre_run_hook(self)
-        iteration = 0
+        if not dry:
+            self.live_log.reset()
+        if self.dispatcher is not None and not dry:
+            return self.dispatcher.run(self, self.iterate_batches(dry))
         last = None
-        for set in self.value_sets:
-            if set.do_skip:
-                continue
+        for batch in self.iterate_batches(dry):
+            last = self.run_batch(batch)
+        return last
+
+    def iterate_batches(self, dry: bool):
+        """Applies each pending call, skipping duplicates and cache hits, and yields batches of (params, call)."""
+        iteration = 0
+        batch = list()
+        batch_key = None
+        for set in self.iterate_pending(dry):
             iteration += 1
             if not dry:
+                self.journal.record(set.relative_path, "queued")
+                effective_hash = set.get_effective_hash(self.p)
+                original = self.generated_by_hash.get(effective_hash) if effective_hash is not None else None
+                if original is not None:
+                    print(f'On {iteration}/{self.total_run} ... Set: {set.data}, file {set.filepath} (identical to {self.base_path}/{original})')
+                    self.add_duplicate(set, original)
+                    continue
+                if effective_hash is not None:
+                    self.remember_generated(effective_hash, set)
+                if self.image_cache is not None and self.fetch_cached(set):
+                    print(f'On {iteration}/{self.total_run} ... Set: {set.data}, file {set.filepath} (reused from image cache)')
+                    continue
                 print(f'On {iteration}/{self.total_run} ... Set: {set.data}, file {set.filepath}')
+                if len(batch) > 0 and (len(batch) >= self.batch_size or self.get_batch_key(set) != batch_key):
+                    yield batch
+                    batch = list()
             p = copy(self.p)
-            if grid_runner_pre_dry_hook is not None:
+            if grid_runner_pre_dry_hook is not None and len(batch) == 0:
                 grid_runner_pre_dry_hook(self)
-            set.apply_to(p, dry)
+            with self.profiler.span("apply", "cell", cell=set.relative_path):
+                set.apply_to(p, dry)
             if dry:
                 continue
-            try:
-                last = grid_runner_post_dry_hook(self, p, set)
-            except FileNotFoundError as e:
-                if e.strerror == 'The filename or extension is too long' and hasattr(e, 'winerror') and e.winerror == 206:
-                    print(f"\n\n\nOS Error: {e.strerror} - see this article to fix that: https://www.autodesk.com/support/technical/article/caas/sfdcarticles/sfdcarticles/The-Windows-10-default-path-length-limitation-MAX-PATH-is-256-characters.html \n\n\n")
-                raise e
-            self.update_live_file(set.filepath + "." + self.grid.format)
-        return last
+            if len(batch) == 0 and self.batch_size > 1:
+                batch_key = self.get_batch_key(set)
+            batch.append((p, set))
+        if len(batch) > 0:
+            yield batch
 
 ######################### Web Data Builders #########################
 
 class WebDataBuilder():
-    def build_json(grid: GridFileHelper, publish_gen_metadata: bool, p, dry_run: bool):
+    def json_fragments(grid: GridFileHelper, publish_gen_metadata: bool, p, thumbnail_widths: list = None):
         def get_axis(axis: str):
             id = grid.read_str_from_grid(axis)
             if id is None:
@@ -563,23 +1863,23 @@ class WebDataBuilder():
                 'y2': get_axis('y super axis')
             }
         }
-        if not dry_run:
-            result['will_run'] = True
+        if thumbnail_widths:
+            result['thumbnails'] = thumbnail_widths
         if publish_gen_metadata:
             result['metadata'] = None if webdata_get_base_param_data is None else webdata_get_base_param_data(p)
-        axes = list()
-        for axis in grid.axes:
+            result['metadata_shard_depth'] = get_metadata_shard_depth(grid)
+        yield json.dumps(result)[:-1] + ', "axes": ['
+        for axis_index, axis in enumerate(grid.axes):
             j_axis = {
                 'id': str(axis.id).lower(),
                 'title': axis.title,
                 'description': axis.description or ""
             }
+            yield (', ' if axis_index > 0 else '') + json.dumps(j_axis)[:-1] + ', "values": ['
             exported_paths = {}
-            values = list()
             for val in axis.values:
                 if val.path in exported_paths:
                     continue
-                exported_paths[val.path] = val
                 j_val = {
                     'key': str(val.key).lower(),
                     'path': str(val.path),
@@ -589,11 +1889,10 @@ class WebDataBuilder():
                 }
                 if publish_gen_metadata:
                     j_val['params'] = val.params
-                values.append(j_val)
-            j_axis['values'] = values
-            axes.append(j_axis)
-        result['axes'] = axes
-        return json.dumps(result)
+                yield (', ' if len(exported_paths) > 0 else '') + json.dumps(j_val)
+                exported_paths[val.path] = val
+            yield ']}'
+        yield ']}'
 
     def radio_button_html(name, id, descrip, label):
         return f'<input type="radio" class="btn-check" name="{name}" id="{str(id).lower()}" autocomplete="off" checked=""><label class="btn btn-outline-primary" for="{str(id).lower()}" title="{descrip}">{escape_html(label)}</label>\n'
@@ -601,78 +1900,107 @@ class WebDataBuilder():
     def axis_bar(label, content):
         return f'<br><div class="btn-group" role="group" aria-label="Basic radio toggle button group">{label}:&nbsp;\n{content}</div>\n'
 
-    def build_html(grid):
-        with open(ASSET_DIR + "/page.html", 'r', encoding="utf-8") as reference_html:
-            html = reference_html.read()
-        x_select = ""
-        y_select = ""
-        x2Select = WebDataBuilder.radio_button_html('x2_axis_selector', f'x2_none', 'None', 'None')
-        y2Select = WebDataBuilder.radio_button_html('y2_axis_selector', f'y2_none', 'None', 'None')
-        content = '<div style="margin: auto; width: fit-content;"><table class="sel_table">\n'
-        advanced_settings = ''
+    def axis_content_fragments(axis, primary: bool):
+        axis_descrip = clean_for_web(axis.description or '')
+        tr_class = "primary" if primary else "secondary"
+        yield f'<tr class="{tr_class}">\n<td>\n<h4>{escape_html(axis.title)}</h4>\n'
+        axis_class = "axis_table_cell"
+        if len(axis_descrip.strip()) == 0:
+            axis_class += " emptytab"
+        yield f'<div class="{axis_class}">{axis_descrip}</div></td>\n<td><ul class="nav nav-tabs" role="tablist" id="tablist_{axis.id}">\n'
+        is_first = axis.default is None
+        exported_paths = {}
+        for val in axis.values:
+            if val.path in exported_paths:
+                continue
+            exported_paths[val.path] = val
+            if axis.default is not None:
+                is_first = str(axis.default) == str(val.key)
+            selected = "true" if is_first else "false"
+            active = " active" if is_first else ""
+            is_first = False
+            descrip = clean_for_web(val.description or '')
+            yield f'<li class="nav-item" role="presentation"><a class="nav-link{active}" data-bs-toggle="tab" href="#tab_{axis.id}__{val.key}" id="clicktab_{axis.id}__{val.key}" aria-selected="{selected}" role="tab" title="{escape_html(val.title)}: {descrip}">{escape_html(val.title)}</a></li>\n'
+        yield '</ul>\n<div class="tab-content">\n'
+        is_first = axis.default is None
+        for val in axis.values:
+            if axis.default is not None:
+                is_first = str(axis.default) == str(val.key)
+            active = " active show" if is_first else ""
+            is_first = False
+            descrip = clean_for_web(val.description or '')
+            if len(descrip.strip()) == 0:
+                active += " emptytab"
+            yield f'<div class="tab-pane{active}" id="tab_{axis.id}__{val.key}" role="tabpanel"><div class="tabval_subdiv">{descrip}</div></div>\n'
+
+    def content_fragments(grid):
+        yield '<div style="margin: auto; width: fit-content;"><table class="sel_table">\n'
         primary = True
         for axis in grid.axes:
             try:
-                axis_descrip = clean_for_web(axis.description or '')
-                tr_class = "primary" if primary else "secondary"
-                content += f'<tr class="{tr_class}">\n<td>\n<h4>{escape_html(axis.title)}</h4>\n'
-                advanced_settings += f'\n<h4>{axis.title}</h4><div class="timer_box">Auto cycle every <input style="width:30em;" autocomplete="off" type="range" min="0" max="360" value="0" class="form-range timer_range" id="range_tablist_{axis.id}"><label class="form-check-label" for="range_tablist_{axis.id}" id="label_range_tablist_{axis.id}">0 seconds</label></div>\nShow value: '
-                axis_class = "axis_table_cell"
-                if len(axis_descrip.strip()) == 0:
-                    axis_class += " emptytab"
-                content += f'<div class="{axis_class}">{axis_descrip}</div></td>\n<td><ul class="nav nav-tabs" role="tablist" id="tablist_{axis.id}">\n'
-                primary = not primary
-                is_first = axis.default is None
+                yield from WebDataBuilder.axis_content_fragments(axis, primary)
+            except Exception as e:
+                raise RuntimeError(f"Failed to build HTML for axis '{axis.id}': {e}")
+            primary = not primary
+            yield '</div></td></tr>\n'
+        yield '</table>\n<div class="axis_selectors">'
+        for label, prefix in [('X Axis', 'x'), ('Y Axis', 'y'), ('X Super-Axis', 'x2'), ('Y Super-Axis', 'y2')]:
+            buttons = WebDataBuilder.radio_button_html(f'{prefix}_axis_selector', f'{prefix}_none', 'None', 'None') if prefix in ['x2', 'y2'] else ''
+            for axis in grid.axes:
+                buttons += WebDataBuilder.radio_button_html(f'{prefix}_axis_selector', f'{prefix}_{axis.id}', clean_for_web(axis.description or ''), axis.title)
+            yield WebDataBuilder.axis_bar(label, buttons)
+        yield '</div></div>\n'
+
+    def advanced_settings_fragments(grid):
+        for axis in grid.axes:
+            try:
+                yield f'\n<h4>{axis.title}</h4><div class="timer_box">Auto cycle every <input style="width:30em;" autocomplete="off" type="range" min="0" max="360" value="0" class="form-range timer_range" id="range_tablist_{axis.id}"><label class="form-check-label" for="range_tablist_{axis.id}" id="label_range_tablist_{axis.id}">0 seconds</label></div>\nShow value: '
                 exported_paths = {}
                 for val in axis.values:
                     if val.path in exported_paths:
                         continue
                     exported_paths[val.path] = val
-                    if axis.default is not None:
-                        is_first = str(axis.default) == str(val.key)
-                    selected = "true" if is_first else "false"
-                    active = " active" if is_first else ""
-                    is_first = False
-                    descrip = clean_for_web(val.description or '')
-                    content += f'<li class="nav-item" role="presentation"><a class="nav-link{active}" data-bs-toggle="tab" href="#tab_{axis.id}__{val.key}" id="clicktab_{axis.id}__{val.key}" aria-selected="{selected}" role="tab" title="{escape_html(val.title)}: {descrip}">{escape_html(val.title)}</a></li>\n'
-                    advanced_settings += f'&nbsp;<input class="form-check-input" type="checkbox" autocomplete="off" id="showval_{axis.id}__{val.key}" checked="true" onchange="javascript:toggleShowVal(\'{axis.id}\', \'{val.key}\')"> <label class="form-check-label" for="showval_{axis.id}__{val.key}" title="Uncheck this to hide \'{escape_html(val.title)}\' from the page.">{escape_html(val.title)}</label>'
-                advanced_settings += f'&nbsp;&nbsp;<button class="submit" onclick="javascript:toggleShowAllAxis(\'{axis.id}\')">Toggle All</button>'
-                content += '</ul>\n<div class="tab-content">\n'
-                is_first = axis.default is None
-                for val in axis.values:
-                    if axis.default is not None:
-                        is_first = str(axis.default) == str(val.key)
-                    active = " active show" if is_first else ""
-                    is_first = False
-                    descrip = clean_for_web(val.description or '')
-                    if len(descrip.strip()) == 0:
-                        active += " emptytab"
-                    content += f'<div class="tab-pane{active}" id="tab_{axis.id}__{val.key}" role="tabpanel"><div class="tabval_subdiv">{descrip}</div></div>\n'
+                    yield f'&nbsp;<input class="form-check-input" type="checkbox" autocomplete="off" id="showval_{axis.id}__{val.key}" checked="true" onchange="javascript:toggleShowVal(\'{axis.id}\', \'{val.key}\')"> <label class="form-check-label" for="showval_{axis.id}__{val.key}" title="Uncheck this to hide \'{escape_html(val.title)}\' from the page.">{escape_html(val.title)}</label>'
+                yield f'&nbsp;&nbsp;<button class="submit" onclick="javascript:toggleShowAllAxis(\'{axis.id}\')">Toggle All</button>'
             except Exception as e:
                 raise RuntimeError(f"Failed to build HTML for axis '{axis.id}': {e}")
-            content += '</div></td></tr>\n'
-            x_select += WebDataBuilder.radio_button_html('x_axis_selector', f'x_{axis.id}', axis_descrip, axis.title)
-            y_select += WebDataBuilder.radio_button_html('y_axis_selector', f'y_{axis.id}', axis_descrip, axis.title)
-            x2Select += WebDataBuilder.radio_button_html('x2_axis_selector', f'x2_{axis.id}', axis_descrip, axis.title)
-            y2Select += WebDataBuilder.radio_button_html('y2_axis_selector', f'y2_{axis.id}', axis_descrip, axis.title)
-        content += '</table>\n<div class="axis_selectors">'
-        content += WebDataBuilder.axis_bar('X Axis', x_select)
-        content += WebDataBuilder.axis_bar('Y Axis', y_select)
-        content += WebDataBuilder.axis_bar('X Super-Axis', x2Select)
-        content += WebDataBuilder.axis_bar('Y Super-Axis', y2Select)
-        content += '</div></div>\n'
-        html = html.replace("{TITLE}", grid.title).replace("{CLEAN_DESCRIPTION}", clean_for_web(grid.description)).replace("{DESCRIPTION}", grid.description).replace("{CONTENT}", content).replace("{ADVANCED_SETTINGS}", advanced_settings).replace("{AUTHOR}", grid.author).replace("{EXTRA_FOOTER}", EXTRA_FOOTER).replace("{VERSION}", get_version())
-        return html
-
-    def emit_web_data(path: str, grid, publish_gen_metadata: bool, p, yaml_content: dict, dry_run: bool):
+
+    def html_fragments(grid):
+        with open(ASSET_DIR + "/page.html", 'r', encoding="utf-8") as reference_html:
+            template = reference_html.read()
+        values = {
+            "TITLE": grid.title,
+            "CLEAN_DESCRIPTION": clean_for_web(grid.description),
+            "DESCRIPTION": grid.description,
+            "CONTENT": WebDataBuilder.content_fragments(grid),
+            "ADVANCED_SETTINGS": WebDataBuilder.advanced_settings_fragments(grid),
+            "AUTHOR": grid.author,
+            "EXTRA_FOOTER": EXTRA_FOOTER,
+            "VERSION": get_version()
+        }
+        last = 0
+        for match in re.finditer(r"\{(" + "|".join(values.keys()) + r")\}", template):
+            yield template[last:match.start()]
+            value = values[match.group(1)]
+            if isinstance(value, str):
+                yield value
+            else:
+                yield from value
+            last = match.end()
+        yield template[last:]
+
+    def build_html(grid):
+        return "".join(WebDataBuilder.html_fragments(grid))
+
+    def emit_web_data(path: str, grid, publish_gen_metadata: bool, p, yaml_content: dict, dry_run: bool, thumbnail_widths: list = None):
         print("Building final web data...")
         os.makedirs(path, exist_ok=True)
-        json = WebDataBuilder.build_json(grid, publish_gen_metadata, p, dry_run)
-        if not dry_run:
-            with open(path + '/last.js', 'w', encoding="utf-8") as f:
-                f.write("window.lastUpdated = []")
         with open(path + "/data.js", 'w', encoding="utf-8") as f:
-            f.write("rawData = " + json)
+            f.write("rawData = ")
+            for fragment in WebDataBuilder.json_fragments(grid, publish_gen_metadata, p, thumbnail_widths):
+                f.write(fragment)
+            if not dry_run:
+                f.write(WILL_RUN_MARKER)
         with open(path + "/config.yml", 'w', encoding="utf-8") as f:
             yaml.dump(yaml_content, f, sort_keys=False, default_flow_style=False, width=1000)
         for f in ["bootstrap.min.css", "jsgif.js", "bootstrap.bundle.min.js", "proc.js", "jquery.min.js", "styles.css", "placeholder.png"] + EXTRA_ASSETS:
@@ -680,35 +2008,35 @@ class WebDataBuilder():
         with open(ASSET_DIR + "/styles-user.css", 'r', encoding="utf-8") as style:
             with open(path + "/styles-user.css", 'w', encoding="utf-8") as f:
                 f.write(style.read() + '\n' + (grid.stylesheet or ''))
-        html = WebDataBuilder.build_html(grid)
         with open(path + "/index.html", 'w', encoding="utf-8") as f:
-            f.write(html)
+            for fragment in WebDataBuilder.html_fragments(grid):
+                f.write(fragment)
         print(f"Web file is now at {path}/index.html")
-        return json
+
+    def finalize_web_data(path: str):
+        """Cuts the 'will_run' marker off the end of 'data.js' without rewriting the rest."""
+        data_path = path + "/data.js"
+        marker = WILL_RUN_MARKER.encode('utf-8')
+        size = os.path.getsize(data_path)
+        with open(data_path, 'rb') as f:
+            f.seek(max(0, size - len(marker)))
+            if f.read() != marker:
+                return
+        os.truncate(data_path, size - len(marker))
 
 ######################### Main Runner Function #########################
 
 def run_grid_gen(pass_through_obj, input_file: str, output_folder_base: str, output_folder_name: str = None, do_overwrite: bool = False,
-               fast_skip: bool = False, generate_page: bool = True, publish_gen_metadata: bool = True, dry_run: bool = False, manual_pairs: list = None, allow_includes: bool = True, skip_invalid: bool = False):
-    grid = GridFileHelper()
-    grid.stylesheet = ''
-    grid.skip_invalid = skip_invalid
-    yaml_content = None
+               fast_skip: bool = False, generate_page: bool = True, publish_gen_metadata: bool = True, dry_run: bool = False, manual_pairs: list = None, allow_includes: bool = True, skip_invalid: bool = False, batch_size: int = 1, rebuild_changed: bool = False,
+               cache_dir: str = None, cache_max_size_mb: float = 10240, save_workers: int = 2, save_processes: bool = False, thumbnails: bool = False, dispatcher=None, shard: GridShard = None, profile: bool = False):
+    profiler = GridProfiler(profile)
     if manual_pairs is None:
-        full_input_path = ASSET_DIR + "/" + input_file
-        if not os.path.exists(full_input_path):
-            raise RuntimeError(f"Non-existent file '{input_file}'")
-        # Parse and verify
-        with open(full_input_path, 'r', encoding="utf-8") as yaml_content_text:
-            try:
-                if allow_includes:
-                    yaml_content = yaml.load(yaml_content_text, Loader=GridYamlLoader)
-                else:
-                    yaml_content = yaml.safe_load(yaml_content_text)
-            except yaml.YAMLError as exc:
-                raise RuntimeError(f"Invalid YAML in file '{input_file}': {exc}")
-        grid.parse_yaml(yaml_content, input_file)
+        with profiler.span("load grid file"):
+            grid, yaml_content = load_grid_file(input_file, allow_includes, skip_invalid, profiler)
     else:
+        grid = GridFileHelper()
+        grid.stylesheet = ''
+        grid.skip_invalid = skip_invalid
         grid.title = output_folder_name
         grid.description = ""
         grid.variables = dict()
@@ -717,6 +2045,7 @@ def run_grid_gen(pass_through_obj, input_file: str, output_folder_base: str, out
         grid.axes = list()
         grid.params = None
         grid.grid_obj = {}
+        grid.encode_options = {}
         yaml_content = {
             'grid': {
                 'title': grid.title,
@@ -750,16 +2079,1084 @@ def run_grid_gen(pass_through_obj, input_file: str, output_folder_base: str, out
         folder = output_folder_name
     else:
         folder = output_folder_base + "/" + output_folder_name
-    runner = GridRunner(grid, do_overwrite, folder, pass_through_obj, fast_skip)
-    runner.preprocess()
+    runner = GridRunner(grid, do_overwrite, folder, pass_through_obj, fast_skip, batch_size, rebuild_changed)
+    runner.dispatcher = dispatcher
+    runner.shard = shard
+    runner.profiler = profiler
+    if cache_dir is not None and not dry_run:
+        if runner.unhashable_state is not None:
+            # The cache is keyed by param hash, so an image made with settings that can't be hashed could be mistaken for a different one
+            print(f"Not reusing images from other grids, as the current settings can't be compared: {runner.unhashable_state}")
+        else:
+            runner.image_cache = ImageCache(cache_dir, cache_max_size_mb)
+    if rebuild_changed and runner.unhashable_state is not None:
+        print(f"Some of the current settings can't be compared ({runner.unhashable_state}), so changes to them won't cause images to be regenerated")
+    if save_workers > 0 and not dry_run:
+        runner.save_queue = ImageSaveQueue(save_workers, use_processes=save_processes, profiler=profiler, name="save")
+    if publish_gen_metadata and not dry_run:
+        runner.metadata_index = MetadataIndex(folder + "/meta", get_metadata_shard_depth(grid))
+        runner.metadata_index.reshard()
+    if thumbnails and not dry_run and grid.format.lower() in ["png", "jpg", "jpeg", "webp"]:
+        runner.thumbnail_widths = THUMBNAIL_WIDTHS
+    # Images are normally encoded as they are saved, so this is only for images that have to be read back (like existing ones that need thumbnails)
+    if (len(grid.encode_options) > 0 or len(runner.thumbnail_widths) > 0) and not dry_run:
+        runner.encode_queue = ImageSaveQueue(os.cpu_count() or 1, use_processes=True, profiler=profiler, name="encode")
+    with profiler.span("preprocess"):
+        runner.preprocess()
     if generate_page:
-        json = WebDataBuilder.emit_web_data(folder, grid, publish_gen_metadata, pass_through_obj, yaml_content, dry_run)
-    result = runner.run(dry_run)
+        with profiler.span("emit web data"):
+            WebDataBuilder.emit_web_data(folder, grid, publish_gen_metadata, pass_through_obj, yaml_content, dry_run, runner.thumbnail_widths)
+    try:
+        with profiler.span("run"):
+            result = runner.run(dry_run)
+    finally:
+        # Saves can queue encodes, so saving must finish first
+        with profiler.span("finish saving"):
+            for queue in [runner.save_queue, runner.encode_queue]:
+                if queue is not None:
+                    queue.shutdown()
+        runner.journal.close()
+    for name, queue in [("Saved", runner.save_queue), ("Encoded", runner.encode_queue)]:
+        stats = queue.stats() if queue is not None else None
+        if stats is not None and stats['completed'] + stats['failed'] > 0:
+            print(f"{name} {stats['completed']} images ({stats['failed']} failed) with up to {stats['max_depth']} queued, spending {stats['encode_seconds']:.1f}s working and {stats['wait_seconds']:.1f}s waiting for the queue")
     if dry_run:
         print("Infinite Grid dry run succeeded without error")
     else:
-        json = json.replace('"will_run": true, ', '')
-        with open(folder + "/data.js", 'w', encoding="utf-8") as f:
-            f.write("rawData = " + json)
-        os.remove(folder + "/last.js")
+        with profiler.span("finalize"):
+            if generate_page:
+                WebDataBuilder.finalize_web_data(folder)
+            runner.link_remaining_duplicates()
+            runner.record_unreported_saves()
+            runner.journal.compact()
+            runner.live_log.close()
+            runner.param_hashes.compact()
+            if runner.metadata_index is not None:
+                runner.metadata_index.compact()
+            if shard is not None:
+                runner.write_shard_manifest()
+            if runner.image_cache is not None:
+                runner.image_cache.save()
+                stats = runner.image_cache.stats()
+                print(f"Image cache: {stats['hits']} hits and {stats['misses']} misses this run ({stats['hit_rate'] * 100:.1f}% hit rate, {stats['total_hit_rate'] * 100:.1f}% all-time), holding {stats['entries']} images in {stats['size_mb']:.1f} MB")
+    if profile:
+        os.makedirs(folder, exist_ok=True)
+        profiler.write(folder + "/timeline.json")
+        print(f"Timeline is now at {folder}/timeline.json, phases took: {', '.join(profiler.summary('phase'))}")
     return result
+
+def merge_grid_shards(shard_folders: list, out_folder: str):
+    """Links the images of every shard of a sharded run into one output folder, failing without writing anything if the shards don't fit together."""
+    manifests = []
+    for folder in shard_folders:
+        paths = glob.glob(glob.escape(folder) + "/shard_*_of_*.json")
+        if len(paths) != 1:
+            raise RuntimeError(f"Shard folder '{folder}' must contain exactly one shard manifest, but has {len(paths)}")
+        with open(paths[0], 'r', encoding="utf-8") as f:
+            manifests.append((folder, json.load(f)))
+    first = manifests[0][1]
+    for key in ['count', 'mode', 'total_cells', 'fingerprint', 'format']:
+        for folder, manifest in manifests:
+            if manifest[key] != first[key]:
+                raise RuntimeError(f"Shard in '{folder}' has a different {key} ('{manifest[key]}') than the first shard ('{first[key]}'), so is not from the same grid run with the same settings")
+    if first['fingerprint'] is None:
+        raise RuntimeError("Shards were run without generating the web page, so there is no page to merge")
+    indices = sorted(manifest['shard'] for _, manifest in manifests)
+    if indices != list(range(1, first['count'] + 1)):
+        missing = sorted(set(range(1, first['count'] + 1)) - set(indices))
+        duplicated = sorted(set(i for i in indices if indices.count(i) > 1))
+        raise RuntimeError(f"Need each of the {first['count']} shards exactly once, but shards {missing} are missing and shards {duplicated} are given more than once")
+    owners = dict()
+    for folder, manifest in manifests:
+        for cell, kind in manifest['cells'].items():
+            if cell in owners:
+                raise RuntimeError(f"Cell '{cell}' is in both '{owners[cell]}' and '{folder}'")
+            owners[cell] = folder
+            if kind == "image" and not os.path.exists(f"{folder}/{cell}.{manifest['format']}"):
+                raise RuntimeError(f"Cell '{cell}' has no image in '{folder}': that shard didn't finish, run it again before merging")
+    if len(owners) != first['total_cells']:
+        raise RuntimeError(f"Shards cover {len(owners)} cells, but the grid has {first['total_cells']}")
+    os.makedirs(out_folder, exist_ok=True)
+    first_folder = manifests[0][0]
+    for name in os.listdir(first_folder):
+        if os.path.isfile(f"{first_folder}/{name}") and name not in ["param_hashes.txt", "journal.log", "timeline.json"] and not re.fullmatch(r"shard_\d+_of_\d+\.json", name):
+            shutil.copyfile(f"{first_folder}/{name}", f"{out_folder}/{name}")
+    param_hashes = ParamHashLog(out_folder + "/param_hashes.txt")
+    meta_entries = dict()
+    for folder, manifest in manifests:
+        suffixes = [manifest['format']] + ([manifest['secondary_format']] if manifest['secondary_format'] is not None else [])
+        for cell, kind in manifest['cells'].items():
+            if kind != "image":
+                continue
+            files = [f"{cell}.{suffix}" for suffix in suffixes] + [f"thumbs/{width}/{cell}.webp" for width in manifest['thumbnail_widths']]
+            for file in files:
+                if os.path.exists(f"{folder}/{file}"):
+                    os.makedirs(os.path.dirname(f"{out_folder}/{file}"), exist_ok=True)
+                    link_or_copy_file(f"{folder}/{file}", f"{out_folder}/{file}")
+        shard_hashes = ParamHashLog(folder + "/param_hashes.txt")
+        param_hashes.hashes.update({cell: hash for cell, hash in shard_hashes.hashes.items() if owners.get(cell) == folder})
+        for path in glob.glob(glob.escape(folder) + "/meta/**/*.js", recursive=True):
+            entries, _ = MetadataIndex.read_entries(path)
+            merged = meta_entries.setdefault(os.path.relpath(path, folder), dict())
+            merged.update({cell: data for cell, data in entries.items() if owners.get(cell) == folder})
+    param_hashes.write()
+    for path, entries in meta_entries.items():
+        MetadataIndex.write_entries(f"{out_folder}/{path}", entries)
+    if os.path.exists(first_folder + "/meta/depth.txt"):
+        os.makedirs(out_folder + "/meta", exist_ok=True)
+        shutil.copyfile(first_folder + "/meta/depth.txt", out_folder + "/meta/depth.txt")
+    print(f"Merged {len(manifests)} shards covering {len(owners)} cells into {out_folder}")
+
+######################### Headless Backends #########################
+
+class HeadlessParams:
+    """Stands in for the WebUI's processing object in headless runs."""
+    def __init__(self, **kwargs):
+        self.prompt = ""
+        self.negative_prompt = ""
+        self.seed = -1
+        self.subseed = -1
+        self.subseed_strength = 0
+        self.steps = 20
+        self.cfg_scale = 7
+        self.width = 512
+        self.height = 512
+        self.sampler_name = "Euler a"
+        self.model = None
+        self.denoising_strength = None
+        self.__dict__.update(kwargs)
+
+def build_infotext(p: HeadlessParams):
+    """Returns generation info text in the WebUI's layout."""
+    text = p.prompt
+    if p.negative_prompt:
+        text += f"\nNegative prompt: {p.negative_prompt}"
+    fields = [f"Steps: {p.steps}", f"Sampler: {p.sampler_name}", f"CFG scale: {p.cfg_scale}", f"Seed: {p.seed}", f"Size: {p.width}x{p.height}"]
+    if p.model is not None:
+        fields.append(f"Model: {p.model}")
+    if p.subseed_strength:
+        fields += [f"Variation seed: {p.subseed}", f"Variation seed strength: {p.subseed_strength}"]
+    if p.denoising_strength is not None:
+        fields.append(f"Denoising strength: {p.denoising_strength}")
+    return text + "\n" + ", ".join(fields)
+
+class GridBackend:
+    """Generates grids without the WebUI: 'install' registers its modes and hooks, and subclasses implement 'generate'."""
+    name = "backend"
+
+    def list_models(self):
+        return None
+
+    def list_samplers(self):
+        return None
+
+    def get_base_model(self):
+        return None
+
+    def generate(self, p: HeadlessParams):
+        """Returns (PIL image, generation info text) for the given params."""
+        raise NotImplementedError()
+
+    def generate_batch(self, params: list):
+        return [self.generate(p) for p in params]
+
+    def register_modes(self):
+        valid_modes.clear()
+        overrides = lambda name: getattr(type(self), name) is not getattr(GridBackend, name)
+        registerMode("Model", GridSettingMode(dry=False, type="text", apply=apply_field("model"), switch_cost=10, valid_list=self.list_models if overrides("list_models") else None))
+        registerMode("Sampler", GridSettingMode(dry=True, type="text", apply=apply_field("sampler_name"), valid_list=self.list_samplers if overrides("list_samplers") else None))
+        registerMode("Seed", GridSettingMode(dry=True, type="integer", apply=apply_field("seed"), batchable=True))
+        registerMode("Steps", GridSettingMode(dry=True, type="integer", min=0, max=200, apply=apply_field("steps")))
+        registerMode("CFG Scale", GridSettingMode(dry=True, type="decimal", min=0, max=500, apply=apply_field("cfg_scale")))
+        registerMode("Width", GridSettingMode(dry=True, type="integer", apply=apply_field("width")))
+        registerMode("Height", GridSettingMode(dry=True, type="integer", apply=apply_field("height")))
+        registerMode("Prompt", GridSettingMode(dry=True, type="text", apply=apply_field("prompt"), batchable=True))
+        registerMode("Negative Prompt", GridSettingMode(dry=True, type="text", apply=apply_field("negative_prompt"), batchable=True))
+        registerMode("Prompt Replace", GridSettingMode(dry=True, type="text", apply=apply_prompt_replace, parse_list=prompt_replace_parse_list, batchable=True))
+        registerMode("Var Seed", GridSettingMode(dry=True, type="integer", apply=apply_field("subseed"), batchable=True))
+        registerMode("Var Strength", GridSettingMode(dry=True, type="decimal", min=0, max=1, apply=apply_field("subseed_strength")))
+        registerMode("Denoising", GridSettingMode(dry=True, type="decimal", min=0, max=1, apply=apply_field("denoising_strength")))
+        registerMode("Out Width", GridSettingMode(dry=True, type="integer", min=0, apply=apply_field("inf_grid_out_width")))
+        registerMode("Out Height", GridSettingMode(dry=True, type="integer", min=0, apply=apply_field("inf_grid_out_height")))
+
+    def install(self):
+        global grid_call_init_hook, grid_call_param_add_hook, grid_call_apply_hook, grid_runner_pre_run_hook, grid_runner_pre_dry_hook, grid_runner_post_dry_hook, grid_runner_post_dry_batch_hook, grid_runner_count_steps, webdata_get_base_param_data, grid_runner_get_extra_state
+        self.register_modes()
+        grid_call_init_hook = None
+        grid_call_param_add_hook = self.param_add_hook
+        grid_call_apply_hook = self.apply_hook
+        grid_runner_pre_run_hook = None
+        grid_runner_pre_dry_hook = None
+        grid_runner_post_dry_hook = self.post_dry_hook
+        grid_runner_post_dry_batch_hook = self.post_dry_batch_hook
+        grid_runner_count_steps = self.count_steps
+        webdata_get_base_param_data = self.get_base_param_data
+        grid_runner_get_extra_state = self.get_extra_state
+
+    def param_add_hook(self, grid_call: SingleGridCall, param: str, value):
+        grid = grid_call.grid
+        if grid.min_width is None:
+            grid.min_width = grid.initial_p.width
+        if grid.min_height is None:
+            grid.min_height = grid.initial_p.height
+        cleaned = clean_mode(param)
+        if cleaned == "promptreplace":
+            if grid_call.hook_data is None:
+                grid_call.hook_data = {}
+            grid_call.hook_data.setdefault('replacements', []).append(value)
+            return True
+        elif cleaned in ["width", "outwidth"]:
+            grid.min_width = min(grid.min_width, int(value))
+        elif cleaned in ["height", "outheight"]:
+            grid.min_height = min(grid.min_height, int(value))
+        return False
+
+    def apply_hook(self, grid_call: SingleGridCall, p, dry: bool):
+        for replace in (grid_call.hook_data or {}).get('replacements', []):
+            apply_prompt_replace(p, replace)
+
+    def save_image(self, grid_runner: GridRunner, p, set: SingleGridCall, img, info: str):
+        if hasattr(p, 'inf_grid_out_width') and hasattr(p, 'inf_grid_out_height'):
+            img = img.resize((p.inf_grid_out_width, p.inf_grid_out_height), resample=Image.LANCZOS)
+        ext = grid_runner.grid.format
+        grid_runner.add_image_metadata(set, {'parameters': info})
+        args = (img, set.filepath + "." + ext, ext, info, grid_runner.grid.encode_options, grid_runner.get_thumbnail_paths(set))
+        on_done = lambda: grid_runner.on_image_saved(set, encoded=True)
+        if grid_runner.save_queue is None:
+            with grid_runner.profiler.span("save", "io", cell=set.relative_path):
+                save_image_file(*args)
+            on_done()
+        else:
+            grid_runner.save_queue.submit(save_image_file, *args, on_done=on_done)
+
+    def post_dry_hook(self, grid_runner: GridRunner, p, set: SingleGridCall):
+        return self.post_dry_batch_hook(grid_runner, [(p, set)])
+
+    def post_dry_batch_hook(self, grid_runner: GridRunner, batch: list):
+        results = self.generate_batch([p for p, _ in batch])
+        if len(results) < len(batch):
+            raise RuntimeError(f"Something went wrong! Image gen of {len(batch)} images for '{batch[0][1].data}' produced {len(results)} images, which is wrong")
+        for (p, set), (img, info) in zip(batch, results):
+            self.save_image(grid_runner, p, set, img, info)
+        return results
+
+    def count_steps(self, grid_runner: GridRunner, set: SingleGridCall):
+        steps = set.params.get("steps")
+        return int(steps) if steps is not None else grid_runner.p.steps
+
+    def get_base_param_data(self, p: HeadlessParams):
+        return {
+            "sampler": p.sampler_name,
+            "seed": p.seed,
+            "steps": p.steps,
+            "cfgscale": p.cfg_scale,
+            "model": p.model,
+            "width": p.width,
+            "height": p.height,
+            "prompt": p.prompt,
+            "negativeprompt": p.negative_prompt,
+            "varseed": (None if p.subseed_strength == 0 else p.subseed),
+            "varstrength": (None if p.subseed_strength == 0 else p.subseed_strength),
+            "denoising": p.denoising_strength
+        }
+
+    def get_extra_state(self, p: HeadlessParams):
+        standard = HeadlessParams().__dict__
+        return {key: val for key, val in p.__dict__.items() if key not in standard}
+
+class DummyBackend(GridBackend):
+    """Draws a deterministic placeholder image from the params, waiting 'step_time' seconds per step."""
+    name = "dummy"
+
+    def __init__(self, step_time: float = 0):
+        self.step_time = step_time
+
+    def generate(self, p: HeadlessParams):
+        digest = hashlib.sha256(json.dumps(vars(p), sort_keys=True, default=str).encode('utf-8')).digest()
+        rng = random.Random(digest)
+        img = Image.new("RGB", (p.width, p.height), tuple(digest[:3]))
+        draw = ImageDraw.Draw(img)
+        for _ in range(8):
+            x, y = rng.randrange(p.width), rng.randrange(p.height)
+            size = rng.randrange(max(2, min(p.width, p.height) // 2))
+            draw.ellipse([x - size, y - size, x + size, y + size], fill=tuple(rng.randrange(256) for _ in range(3)))
+        draw.text((4, 4), f"{p.prompt}\nseed {p.seed}, {p.steps} steps", fill=(255, 255, 255))
+        if self.step_time > 0:
+            time.sleep(self.step_time * p.steps)
+        return img, build_infotext(p)
+
+class HttpBackend(GridBackend):
+    """Generates through a WebUI-style '/sdapi/v1/txt2img' HTTP API."""
+    def __init__(self, url: str, timeout: float = 600):
+        self.url = url.rstrip('/')
+        self.name = self.url
+        self.timeout = timeout
+        self.models = None
+        self.samplers = None
+
+    def request(self, path: str, data: dict = None):
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        request = urllib.request.Request(self.url + path, data=body, headers={"Content-Type": "application/json"}, method="GET" if body is None else "POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Backend request to '{self.url}{path}' failed with HTTP {e.code}: {e.read()[:500].decode('utf-8', errors='replace')}")
+        except urllib.error.URLError as e:
+            raise RuntimeError(f"Cannot reach backend at '{self.url}': {e.reason}")
+
+    def list_models(self):
+        if self.models is None:
+            self.models = [model['title'] for model in self.request("/sdapi/v1/sd-models")]
+        return self.models
+
+    def list_samplers(self):
+        if self.samplers is None:
+            self.samplers = [sampler['name'] for sampler in self.request("/sdapi/v1/samplers")]
+        return self.samplers
+
+    def get_base_model(self):
+        return self.request("/sdapi/v1/options").get("sd_model_checkpoint") or None
+
+    def get_payload(self, p: HeadlessParams):
+        payload = {
+            "prompt": p.prompt,
+            "negative_prompt": p.negative_prompt,
+            "seed": p.seed,
+            "subseed": p.subseed,
+            "subseed_strength": p.subseed_strength,
+            "steps": p.steps,
+            "cfg_scale": p.cfg_scale,
+            "width": p.width,
+            "height": p.height,
+            "sampler_name": p.sampler_name,
+            "send_images": True,
+            "save_images": False
+        }
+        if p.denoising_strength is not None:
+            payload["denoising_strength"] = p.denoising_strength
+        if p.model:
+            payload["override_settings"] = {"sd_model_checkpoint": p.model}
+            payload["override_settings_restore_afterwards"] = False
+        return payload
+
+    def generate(self, p: HeadlessParams):
+        result = self.request("/sdapi/v1/txt2img", self.get_payload(p))
+        images = result.get("images") or []
+        if len(images) == 0:
+            raise RuntimeError(f"Backend at '{self.url}' returned no images for prompt '{p.prompt}'")
+        img = Image.open(io.BytesIO(base64.b64decode(images[0].split(",", 1)[-1])))
+        img.load()
+        info = None
+        try:
+            info = json.loads(result.get("info") or "{}").get("infotexts", [None])[0]
+        except (ValueError, AttributeError, IndexError):
+            pass
+        return img, info or build_infotext(p)
+
+class GridDispatcher:
+    """Spreads batches over several backends, with 'concurrency' (one number, or one per backend) in flight on each."""
+    def __init__(self, backends: list, concurrency = 1, max_failures: int = 3):
+        self.backends = backends
+        limits = concurrency if isinstance(concurrency, list) else [concurrency] * len(backends)
+        if len(limits) != len(backends):
+            raise RuntimeError(f"Got {len(limits)} concurrency limits for {len(backends)} backends")
+        self.limits = [max(1, int(limit)) for limit in limits]
+        self.max_failures = max_failures
+
+    def run(self, grid_runner: GridRunner, batches):
+        return asyncio.run(self.dispatch(grid_runner, iter(batches)))
+
+    @staticmethod
+    def pick(pending: list, index: int, model):
+        eligible = [entry for entry in pending if index not in entry['failed_on']]
+        if len(eligible) == 0:
+            return None
+        entry = next((entry for entry in eligible if entry['model'] == model), eligible[0])
+        pending.remove(entry)
+        return entry
+
+    @staticmethod
+    def generate(grid_runner: GridRunner, backend, batch: list):
+        with grid_runner.profiler.span("generate", "cell", backend=backend.name, cells=[set.relative_path for _, set in batch]):
+            return backend.post_dry_batch_hook(grid_runner, batch)
+
+    async def dispatch(self, grid_runner: GridRunner, batches):
+        pending = list()
+        window = sum(self.limits) * 2
+        # Sized to the limits, as the default executor would cap how many batches are in flight at once
+        executor = ThreadPoolExecutor(max_workers=sum(self.limits), thread_name_prefix="dispatch")
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Condition()
+        states = [{'model': None, 'failures': 0} for _ in self.backends]
+        run = {'exhausted': False, 'in_flight': 0, 'last': None, 'error': None}
+
+        def alive():
+            return {i for i, state in enumerate(states) if state['failures'] < self.max_failures}
+
+        def refill():
+            while not run['exhausted'] and len(pending) < window:
+                batch = next(batches, None)
+                if batch is None:
+                    run['exhausted'] = True
+                else:
+                    pending.append({'batch': batch, 'model': getattr(batch[0][0], 'model', None), 'failed_on': set()})
+            for entry in pending:
+                if alive() <= entry['failed_on'] and run['error'] is None:
+                    run['error'] = RuntimeError(f"Image gen for '{entry['batch'][0][1].data}' failed on every available backend")
+
+        async def worker(index: int, backend: GridBackend):
+            state = states[index]
+            while True:
+                async with changed:
+                    while True:
+                        if state['failures'] < self.max_failures:
+                            refill()
+                        # Wake the other workers whenever this one stops, so none of them is left waiting on a run that is over
+                        if run['error'] is not None or state['failures'] >= self.max_failures:
+                            changed.notify_all()
+                            return
+                        entry = self.pick(pending, index, state['model'])
+                        if entry is not None:
+                            break
+                        if run['exhausted'] and len(pending) == 0 and run['in_flight'] == 0:
+                            changed.notify_all()
+                            return
+                        await changed.wait()
+                    run['in_flight'] += 1
+                batch = entry['batch']
+                try:
+                    grid_runner.unlink_cached_outputs(batch)
+                    run['last'] = await loop.run_in_executor(executor, self.generate, grid_runner, backend, batch)
+                    for _, set in batch:
+                        grid_runner.mark_done(set)
+                    state['model'] = entry['model']
+                    state['failures'] = 0
+                except Exception as e:
+                    state['failures'] += 1
+                    entry['failed_on'].add(index)
+                    dropped = " - too many failures, no longer using it" if state['failures'] >= self.max_failures else ""
+                    print(f"Backend {index + 1} ({backend.name}) failed on '{batch[0][1].data}', requeueing: {e}{dropped}")
+                    async with changed:
+                        pending.insert(0, entry)
+                finally:
+                    async with changed:
+                        run['in_flight'] -= 1
+                        changed.notify_all()
+
+        print(f"Dispatching images across {len(self.backends)} backends, with up to {'/'.join(str(limit) for limit in self.limits)} in flight on each")
+        try:
+            await asyncio.gather(*[worker(index, backend) for index, backend in enumerate(self.backends) for _ in range(self.limits[index])])
+        finally:
+            executor.shutdown(wait=False)
+        if run['error'] is None and (len(pending) > 0 or not run['exhausted']):
+            run['error'] = RuntimeError("Every backend failed, so the grid could not be finished")
+        if run['error'] is not None:
+            raise run['error']
+        return run['last']
+
+def run_headless(backends, input_file: str, output_folder_base: str, output_folder_name: str = None, settings: dict = None, concurrency = 1, **kwargs):
+    """Runs a grid file through a backend, or a list of them (see 'GridDispatcher'), without the WebUI. 'settings' maps mode names to base param values."""
+    backends = backends if isinstance(backends, list) else [backends]
+    clear_caches()
+    backends[0].install()
+    p = HeadlessParams()
+    for name, value in (settings or {}).items():
+        mode = valid_modes.get(clean_mode(name))
+        if mode is None:
+            raise RuntimeError(f"Invalid setting '{name}': unknown mode")
+        mode.apply(p, validate_single_param(name, value))
+    if p.model is None:
+        # Resolved once up front, so images that don't pick a model get the same one on every backend
+        p.model = backends[0].get_base_model()
+    if p.seed == -1:
+        # Every shard of a sharded run has to pick the same seed, or the shards wouldn't be parts of one grid
+        rng = random.Random(input_file) if kwargs.get("shard") is not None else random
+        p.seed = rng.randrange(4294967294)
+    dispatcher = GridDispatcher(backends, concurrency)
+    if len(backends) == 1 and dispatcher.limits[0] == 1:
+        dispatcher = None
+    return run_grid_gen(p, input_file, output_folder_base, output_folder_name or "", dispatcher=dispatcher, **kwargs)
+
+######################### Exporters #########################
+
+def load_web_data(folder: str):
+    """Reads back the web data a grid run wrote to 'data.js'."""
+    path = folder + "/data.js"
+    if not os.path.exists(path):
+        raise RuntimeError(f"Folder '{folder}' does not contain a grid output (no 'data.js')")
+    with open(path, 'r', encoding="utf-8") as f:
+        text = f.read()
+    return json.JSONDecoder().raw_decode(text, text.index('{'))[0]
+
+def find_web_axis(data: dict, id: str):
+    id = str(id).lower()
+    for axis in data['axes']:
+        if axis['id'] == id or str(axis['title']).lower() == id or axis['id'] == clean_id(id):
+            return axis
+    raise RuntimeError(f"Cannot find axis '{id}'... valid: {[axis['id'] for axis in data['axes']]}")
+
+def find_web_value(axis: dict, key: str):
+    key = str(key).lower()
+    for val in axis['values']:
+        if val['key'] == key or val['path'].lower() == key or clean_name(str(val['title'])) == clean_name(key):
+            return val
+    raise RuntimeError(f"Cannot find value '{key}' for axis '{axis['id']}'... valid: {[str(val['title']) for val in axis['values']]}")
+
+class GridSlice:
+    """A 2D slice of a finished grid's output folder, laid out like the viewer's table."""
+    def __init__(self, folder: str, x: str = None, y: str = None, x2: str = None, y2: str = None, fixed: dict = None):
+        self.folder = folder
+        self.data = load_web_data(folder)
+        self.ext = self.data['ext']
+        axes = self.data['axes']
+        defaults = self.data['defaults']
+        used = []
+        def pick(id: str, default_key: str, fallback: str = None):
+            if id is None:
+                id = defaults.get(default_key) or fallback
+            if id is None or str(id).lower() == 'none':
+                return None
+            axis = find_web_axis(self.data, id)
+            if axis['id'] in used:
+                return None
+            used.append(axis['id'])
+            return axis
+        self.x_axis = pick(x, 'x', axes[0]['id'])
+        self.y_axis = pick(y, 'y', axes[1]['id'] if len(axes) > 1 else None)
+        self.x2_axis = pick(x2, 'x2')
+        self.y2_axis = pick(y2, 'y2')
+        self.fixed = dict()
+        for id, key in (fixed or {}).items():
+            axis = find_web_axis(self.data, id)
+            if axis['id'] in used:
+                raise RuntimeError(f"Cannot fix axis '{axis['id']}' to a value, as it is already laid out in the slice")
+            self.fixed[axis['id']] = find_web_value(axis, key)
+        for axis in axes:
+            if axis['id'] not in used and axis['id'] not in self.fixed:
+                self.fixed[axis['id']] = next((val for val in axis['values'] if val['show']), axis['values'][0])
+        self.columns = self.build_lines(self.x_axis, self.x2_axis)
+        self.rows = self.build_lines(self.y_axis, self.y2_axis)
+
+    @staticmethod
+    def build_lines(axis: dict, super_axis: dict):
+        """Returns the columns or rows along an axis, as dicts of 'labels', 'group_start' and 'paths'."""
+        lines = list()
+        for super_val in (super_axis['values'] if super_axis is not None else [None]):
+            if super_val is not None and not super_val['show']:
+                continue
+            first = True
+            for val in (axis['values'] if axis is not None else [None]):
+                if val is not None and not val['show']:
+                    continue
+                labels = [str(val['title'])] if val is not None else []
+                paths = {axis['id']: val['path']} if val is not None else {}
+                if super_val is not None:
+                    paths[super_axis['id']] = super_val['path']
+                    if first:
+                        labels.insert(0, str(super_val['title']))
+                lines.append({'labels': labels, 'group_start': first and super_val is not None, 'paths': paths})
+                first = False
+        return lines
+
+    def image_path(self, row: dict, column: dict):
+        parts = list()
+        for axis in self.data['axes']:
+            id = axis['id']
+            parts.append(column['paths'].get(id) or row['paths'].get(id) or self.fixed[id]['path'])
+        path = self.folder + "/" + "/".join(parts) + "." + self.ext
+        return path if os.path.exists(path) else None
+
+def load_label_font():
+    try:
+        return ImageFont.load_default(16)
+    except TypeError:
+        return ImageFont.load_default()
+
+def wrap_label_text(font, text: str, width: float):
+    lines = list()
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            if line != '' and font.getlength(line + word) > width:
+                lines.append(line.rstrip())
+                line = ''
+            line += word + ' '
+        lines.append(line.rstrip())
+    return lines
+
+def fit_label_text(font, text: str, width: float):
+    while len(text) > 1 and font.getlength(text) > width:
+        text = text[:-1]
+    return text
+
+class CompositeRenderer:
+    """Renders a GridSlice as one labelled image, one full-width band at a time."""
+    BACKGROUND = (0x20, 0x20, 0x20)
+    SECONDARY = (0x30, 0x30, 0x30)
+
+    def __init__(self, slice: GridSlice, size_mult: float = 1.0):
+        self.slice = slice
+        self.size_mult = size_mult
+        self.font = load_label_font()
+        self.paths = list()
+        self.heights = list()
+        self.widest_width = 0
+        for row in slice.rows:
+            paths = [slice.image_path(row, column) for column in slice.columns]
+            sizes = list()
+            for path in paths:
+                if path is not None:
+                    with Image.open(path) as img:
+                        sizes.append(img.size)
+            self.widest_width = max([self.widest_width] + [int(w * size_mult) for w, _ in sizes])
+            self.heights.append(max([int(h * size_mult) for _, h in sizes], default=0))
+            self.paths.append(paths)
+        if self.widest_width == 0:
+            raise RuntimeError(f"No images exist for the selected slice of '{slice.folder}'")
+        fallback_height = max(self.heights)
+        self.heights = [h or fallback_height for h in self.heights]
+        self.pad_y = 64
+        pad_x = 64
+        for row in slice.rows:
+            for label in row['labels']:
+                pad_x = max(pad_x, self.font.getlength(label))
+        self.pad_x = int(min(pad_x, self.widest_width / 2)) + 5
+        self.width = (self.widest_width + 1) * len(slice.columns) + self.pad_x
+        self.height = self.pad_y + sum(h + 1 for h in self.heights)
+
+    def draw_grid_lines(self, draw, height: int):
+        x = self.pad_x - 1
+        for _ in self.slice.columns:
+            draw.rectangle([x, 0, x, height - 1], fill=(0, 0, 0))
+            x += self.widest_width + 1
+
+    def header_band(self):
+        band = Image.new("RGB", (self.width, self.pad_y), self.BACKGROUND)
+        draw = ImageDraw.Draw(band)
+        do_color = False
+        x = self.pad_x
+        for column in self.slice.columns:
+            if column['group_start']:
+                do_color = not do_color
+            if do_color:
+                draw.rectangle([x, 0, x + self.widest_width - 1, self.pad_y - 1], fill=self.SECONDARY)
+            x += self.widest_width + 1
+        self.draw_grid_lines(draw, self.pad_y)
+        x = self.pad_x + 5
+        for column in self.slice.columns:
+            labels = [fit_label_text(self.font, label, self.widest_width - 5) for label in column['labels']]
+            if len(labels) == 2:
+                draw.text((x, 5), labels[0], font=self.font, fill=(255, 255, 255))
+                draw.text((x, 25), labels[1], font=self.font, fill=(255, 255, 255))
+            elif len(labels) == 1:
+                draw.text((x, 25), labels[0], font=self.font, fill=(255, 255, 255))
+            x += self.widest_width + 1
+        return band
+
+    def row_band(self, index: int, do_color: bool):
+        row = self.slice.rows[index]
+        height = self.heights[index] + 1
+        band = Image.new("RGB", (self.width, height), self.BACKGROUND)
+        draw = ImageDraw.Draw(band)
+        if do_color:
+            draw.rectangle([0, 0, self.pad_x - 1, height - 1], fill=self.SECONDARY)
+        draw.rectangle([0, 0, self.width - 1, 0], fill=(0, 0, 0))
+        self.draw_grid_lines(draw, height)
+        y = 5 if len(row['labels']) == 2 else 26
+        for line in wrap_label_text(self.font, "\n".join(row['labels']), self.widest_width / 2):
+            draw.text((5, y), line, font=self.font, fill=(255, 255, 255))
+            y += 16
+        x = self.pad_x
+        for path in self.paths[index]:
+            if path is not None:
+                with Image.open(path) as img:
+                    if self.size_mult != 1:
+                        img = img.resize((int(img.width * self.size_mult), int(img.height * self.size_mult)), Image.LANCZOS)
+                    if img.mode in ["RGBA", "LA", "P"]:
+                        img = img.convert("RGBA")
+                        band.paste(img, (x, 1), img)
+                    else:
+                        band.paste(img.convert("RGB"), (x, 1))
+            x += self.widest_width + 1
+        return band
+
+    def bands(self):
+        yield self.header_band()
+        do_color = False
+        for index, row in enumerate(self.slice.rows):
+            if row['group_start']:
+                do_color = not do_color
+            yield self.row_band(index, do_color)
+
+class StreamingPngWriter:
+    """Writes a PNG band by band."""
+    def __init__(self, path: str, width: int, height: int, compress_level: int = 6):
+        self.width = width
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(compress_level)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, kind: bytes, data: bytes):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, band):
+        data = band.tobytes()
+        stride = self.width * 3
+        rows = b"".join(b"\0" + data[i:i + stride] for i in range(0, len(data), stride))
+        compressed = self.compressor.compress(rows)
+        if len(compressed) > 0:
+            self.write_chunk(b"IDAT", compressed)
+
+    def close(self):
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        self.file.close()
+
+class StreamingTiffWriter:
+    """Writes a deflate-compressed strip TIFF band by band, switching to BigTIFF when needed."""
+    def __init__(self, path: str, width: int, height: int, rows_per_strip: int = 16):
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        self.stride = width * 3
+        self.big = width * height * 3 > 0xF0000000
+        self.file = open(path, 'wb')
+        self.file.write(b"II+\0" + struct.pack("<HHQ", 8, 0, 0) if self.big else b"II*\0" + struct.pack("<I", 0))
+        self.pending = b""
+        self.offsets = list()
+        self.counts = list()
+
+    def write_strip(self, data: bytes):
+        compressed = zlib.compress(data, 6)
+        self.offsets.append(self.file.tell())
+        self.counts.append(len(compressed))
+        self.file.write(compressed)
+
+    def write(self, band):
+        self.pending += band.tobytes()
+        strip_size = self.stride * self.rows_per_strip
+        while len(self.pending) >= strip_size:
+            self.write_strip(self.pending[:strip_size])
+            self.pending = self.pending[strip_size:]
+
+    def close(self):
+        if len(self.pending) > 0:
+            self.write_strip(self.pending)
+        offset_type, offset_format = (16, "Q") if self.big else (4, "I")
+        # tag, type, values; types: 3 = SHORT, 4 = LONG, 16 = LONG8
+        tags = [
+            (256, 4, [self.width]), (257, 4, [self.height]), (258, 3, [8, 8, 8]), (259, 3, [8]), (262, 3, [2]),
+            (273, offset_type, self.offsets), (277, 3, [3]), (278, 4, [self.rows_per_strip]), (279, offset_type, self.counts), (284, 3, [1])
+        ]
+        inline_size = 8 if self.big else 4
+        entries = list()
+        for tag, type, values in tags:
+            data = struct.pack(f"<{len(values)}{'H' if type == 3 else ('Q' if type == 16 else 'I')}", *values)
+            if len(data) > inline_size:
+                if self.file.tell() % 2 == 1:
+                    self.file.write(b"\0")
+                position = self.file.tell()
+                self.file.write(data)
+                data = struct.pack(f"<{offset_format}", position)
+            entries.append(struct.pack(f"<HH{offset_format}", tag, type, len(values)) + data.ljust(inline_size, b"\0"))
+        if self.file.tell() % 2 == 1:
+            self.file.write(b"\0")
+        directory = self.file.tell()
+        self.file.write(struct.pack("<Q" if self.big else "<H", len(entries)) + b"".join(entries) + struct.pack(f"<{offset_format}", 0))
+        self.file.seek(8 if self.big else 4)
+        self.file.write(struct.pack(f"<{offset_format}", directory))
+        self.file.close()
+
+class DeepZoomWriter:
+    """Writes a Deep Zoom ('.dzi') tile pyramid band by band, holding one row of tiles per level."""
+    def __init__(self, path: str, width: int, height: int, tile_size: int = 256, format: str = "jpg", quality: int = 90):
+        self.path = path
+        self.dir = path[:-len(".dzi")] + "_files"
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.format = format
+        self.quality = quality
+        self.max_level = math.ceil(math.log2(max(width, height, 1)))
+        self.levels = dict()
+        for level in range(self.max_level + 1):
+            scale = 2 ** (self.max_level - level)
+            self.levels[level] = {'width': math.ceil(width / scale), 'buffer': None, 'filled': 0, 'tile_row': 0}
+            os.makedirs(f"{self.dir}/{level}", exist_ok=True)
+
+    def flush_level(self, level: int):
+        state = self.levels[level]
+        if state['filled'] == 0:
+            return
+        band = state['buffer'].crop((0, 0, state['width'], state['filled']))
+        for column in range(math.ceil(state['width'] / self.tile_size)):
+            tile = band.crop((column * self.tile_size, 0, min((column + 1) * self.tile_size, state['width']), state['filled']))
+            tile.save(f"{self.dir}/{level}/{column}_{state['tile_row']}.{self.format}", format=get_image_format(self.format), quality=self.quality)
+        state['tile_row'] += 1
+        state['buffer'] = None
+        state['filled'] = 0
+        if level > 0:
+            self.feed(level - 1, band.resize((self.levels[level - 1]['width'], math.ceil(band.height / 2)), Image.LANCZOS))
+
+    def feed(self, level: int, band):
+        state = self.levels[level]
+        y = 0
+        while y < band.height:
+            if state['buffer'] is None:
+                state['buffer'] = Image.new("RGB", (state['width'], self.tile_size))
+            rows = min(band.height - y, self.tile_size - state['filled'])
+            state['buffer'].paste(band.crop((0, y, state['width'], y + rows)), (0, state['filled']))
+            state['filled'] += rows
+            y += rows
+            if state['filled'] == self.tile_size:
+                self.flush_level(level)
+
+    def write(self, band):
+        self.feed(self.max_level, band)
+
+    def close(self):
+        for level in range(self.max_level, -1, -1):
+            self.flush_level(level)
+        with open(self.path, 'w', encoding="utf-8") as f:
+            f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{self.tile_size}" Overlap="0" Format="{self.format}">\n    <Size Width="{self.width}" Height="{self.height}"/>\n</Image>\n')
+
+def export_composite(folder: str, out_path: str, x: str = None, y: str = None, x2: str = None, y2: str = None, fixed: dict = None,
+                     size_mult: float = 1.0, tile_size: int = 256, tile_format: str = "jpg"):
+    """Exports one slice of a finished grid as a single '.png', '.tif' or '.dzi' image of any size."""
+    renderer = CompositeRenderer(GridSlice(folder, x, y, x2, y2, fixed), size_mult)
+    ext = out_path.lower().rsplit('.', 1)[-1]
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    if ext == "png":
+        writer = StreamingPngWriter(out_path, renderer.width, renderer.height)
+    elif ext in ["tif", "tiff"]:
+        writer = StreamingTiffWriter(out_path, renderer.width, renderer.height)
+    elif ext == "dzi":
+        writer = DeepZoomWriter(out_path, renderer.width, renderer.height, tile_size, tile_format)
+    else:
+        raise RuntimeError(f"Cannot export composite as '{out_path}': the file extension must be 'png', 'tif', 'tiff', or 'dzi'")
+    try:
+        for band in renderer.bands():
+            writer.write(band)
+    finally:
+        writer.close()
+    print(f"Exported {len(renderer.slice.columns)}x{len(renderer.slice.rows)} composite of '{folder}' to '{out_path}' ({renderer.width}x{renderer.height})")
+
+def load_animation_frame(path: str, size: tuple):
+    with Image.open(path) as img:
+        frame = img.convert("RGB")
+    if frame.size != size:
+        frame = frame.resize(size, Image.LANCZOS)
+    return frame
+
+def write_gif_animation(out_path: str, paths: list, size: tuple, duration: int):
+    """Writes an animated GIF one frame at a time."""
+    with open(out_path, 'wb') as f:
+        for index, path in enumerate(paths):
+            frame = load_animation_frame(path, size).quantize(256)
+            if index == 0:
+                header, _ = GifImagePlugin.getheader(frame, info={'loop': 0, 'duration': duration})
+                f.write(b"".join(header))
+            f.write(b"".join(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True)))
+        f.write(b";")
+
+def write_webp_animation(out_path: str, paths: list, size: tuple, duration: int, quality: int):
+    """Writes an animated WebP one frame at a time, wrapping the still WebP encoding of each frame in an animation frame chunk."""
+    def chunk(fourcc: bytes, data: bytes):
+        return fourcc + struct.pack("<I", len(data)) + data + (b"\0" if len(data) % 2 else b"")
+    def uint24(value: int):
+        return struct.pack("<I", value)[:3]
+    width, height = size
+    with open(out_path, 'wb') as f:
+        f.write(b"RIFF\0\0\0\0WEBP")
+        # Flag 0x02 marks the file as animated
+        f.write(chunk(b"VP8X", bytes([0x02, 0, 0, 0]) + uint24(width - 1) + uint24(height - 1)))
+        f.write(chunk(b"ANIM", struct.pack("<IH", 0, 0)))
+        for path in paths:
+            buffer = io.BytesIO()
+            load_animation_frame(path, size).save(buffer, format="WEBP", quality=quality)
+            data = buffer.getvalue()
+            frame = b""
+            offset = 12
+            while offset + 8 <= len(data):
+                fourcc = data[offset:offset + 4]
+                length = struct.unpack("<I", data[offset + 4:offset + 8])[0]
+                if fourcc in [b"ALPH", b"VP8 ", b"VP8L"]:
+                    frame += data[offset:offset + 8 + length + (length % 2)]
+                offset += 8 + length + (length % 2)
+            # Frames cover the whole canvas at (0, 0) and replace the previous frame rather than blending over it
+            f.write(chunk(b"ANMF", uint24(0) + uint24(0) + uint24(width - 1) + uint24(height - 1) + uint24(duration) + bytes([0x02]) + frame))
+        riff_size = f.tell() - 8
+        f.seek(4)
+        f.write(struct.pack("<I", riff_size))
+
+def write_video_animation(out_path: str, paths: list, size: tuple, duration: int, quality: int):
+    """Pipes frames into ffmpeg to encode an MP4 or WebM."""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("Cannot export video animations: 'ffmpeg' was not found on the PATH")
+    codec = ["-c:v", "libvpx-vp9", "-b:v", "0"] if out_path.lower().endswith(".webm") else ["-c:v", "libx264", "-preset", "slow"]
+    crf = str(round(51 - quality * 0.41))
+    command = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{size[0]}x{size[1]}", "-framerate", str(1000 / duration), "-i", "-",
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", *codec, "-crf", crf, "-pix_fmt", "yuv420p", out_path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for path in paths:
+            process.stdin.write(load_animation_frame(path, size).tobytes())
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode '{out_path}' (exit code {process.returncode})")
+
+def export_animation(folder: str, out_path: str, axis: str = None, fixed: dict = None, speed: float = 4, size_mult: float = 1.0, reverse: bool = False, quality: int = 80):
+    """Exports the images along one axis of a finished grid as a '.gif', '.webp', '.mp4' or '.webm' animation."""
+    slice = GridSlice(folder, axis, 'none', 'none', 'none', fixed)
+    paths = [slice.image_path(slice.rows[0], column) for column in slice.columns]
+    paths = [path for path in paths if path is not None]
+    if len(paths) == 0:
+        raise RuntimeError(f"No images exist along axis '{slice.x_axis['id']}' for the selected values in '{folder}'")
+    if reverse:
+        paths.reverse()
+    with Image.open(paths[0]) as img:
+        size = (max(1, int(img.width * size_mult)), max(1, int(img.height * size_mult)))
+    duration = int(1000 / speed)
+    ext = out_path.lower().rsplit('.', 1)[-1]
+    if ext not in ["gif", "webp", "mp4", "webm"]:
+        raise RuntimeError(f"Cannot export animation as '{out_path}': the file extension must be 'gif', 'webp', 'mp4', or 'webm'")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    temp = f"{out_path[:-len(ext) - 1]}.tmp.{ext}"
+    try:
+        if ext == "gif":
+            write_gif_animation(temp, paths, size, duration)
+        elif ext == "webp":
+            write_webp_animation(temp, paths, size, duration, quality)
+        else:
+            write_video_animation(temp, paths, size, duration, quality)
+        os.replace(temp, out_path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return len(paths)
+
+def export_all_animations(folder: str, out_dir: str, axis: str = None, ext: str = "gif", speed: float = 4, size_mult: float = 1.0, reverse: bool = False, quality: int = 80, workers: int = None):
+    """Exports an animation along 'axis' for every combination of the other axes, on a process pool."""
+    data = load_web_data(folder)
+    anim_axis = find_web_axis(data, axis or data['axes'][0]['id'])
+    others = [x for x in data['axes'] if x['id'] != anim_axis['id']]
+    combos = list(itertools.product(*[[val for val in x['values'] if val['show']] for x in others]))
+    failed = 0
+    with ProcessPoolExecutor(workers) as executor:
+        futures = dict()
+        for combo in combos:
+            out_path = out_dir + "/" + ("/".join(val['path'] for val in combo) if len(combo) > 0 else anim_axis['id']) + "." + ext
+            fixed = {x['id']: val['key'] for x, val in zip(others, combo)}
+            futures[executor.submit(export_animation, folder, out_path, anim_axis['id'], fixed, speed, size_mult, reverse, quality)] = out_path
+        for future, out_path in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to export animation '{out_path}': {e}")
+    print(f"Exported {len(combos) - failed} animations along axis '{anim_axis['id']}' of '{folder}' to '{out_dir}'" + (f" ({failed} failed)" if failed > 0 else ""))
+
+######################### Command Line #########################
+
+def parse_fixed_values(pairs: list):
+    result = dict()
+    for pair in pairs or []:
+        if '=' not in pair:
+            raise RuntimeError(f"Invalid value '{pair}': must be in the form 'name=value'")
+        axis, val = pair.split('=', 1)
+        result[axis.strip()] = val.strip()
+    return result
+
+def parse_backend_url(text: str, default_limit: int):
+    url, _, limit = text.rpartition('@')
+    if url == "" or not limit.isdigit():
+        return text, default_limit
+    return url, int(limit)
+
+def main(args: list = None):
+    parser = argparse.ArgumentParser(prog="gridgencore.py", description="Tools for working with Infinity Grid Generator output folders.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export one slice of a grid as a single composite image of any size")
+    export.add_argument("folder", help="The grid output folder (containing 'index.html' and 'data.js')")
+    export.add_argument("output", help="Output file: '.png', '.tif'/'.tiff', or '.dzi' for a Deep Zoom tile pyramid")
+    export.add_argument("--x", help="X axis (defaults to the grid's configured default, or the first axis)")
+    export.add_argument("--y", help="Y axis (defaults to the grid's configured default, or the second axis)")
+    export.add_argument("--x2", help="X super axis")
+    export.add_argument("--y2", help="Y super axis")
+    export.add_argument("--fixed", action="append", metavar="AXIS=VALUE", help="Value to use for an axis not in the slice, can be repeated (defaults to the first shown value)")
+    export.add_argument("--scale", type=float, default=1.0, help="Size multiplier for the images")
+    export.add_argument("--tile-size", type=int, default=256, help="Tile size for '.dzi' output")
+    export.add_argument("--tile-format", default="jpg", choices=["jpg", "png", "webp"], help="Tile image format for '.dzi' output")
+    animate = commands.add_parser("animate", help="Export the images along one axis as an animation (GIF, WebP, or via ffmpeg MP4/WebM)")
+    animate.add_argument("folder", help="The grid output folder (containing 'index.html' and 'data.js')")
+    animate.add_argument("output", help="Output file: '.gif', '.webp', '.mp4' or '.webm', or a folder when using '--all'")
+    animate.add_argument("--axis", help="Axis to animate along (defaults to the first axis)")
+    animate.add_argument("--fixed", action="append", metavar="AXIS=VALUE", help="Value to use for another axis, can be repeated (defaults to the first shown value)")
+    animate.add_argument("--speed", type=float, default=4, help="Frames per second")
+    animate.add_argument("--scale", type=float, default=1.0, help="Size multiplier for the frames")
+    animate.add_argument("--reverse", action="store_true", help="Animate backwards through the axis")
+    animate.add_argument("--quality", type=int, default=80, help="Quality for WebP, MP4 and WebM output, from 1 to 100")
+    animate.add_argument("--all", action="store_true", help="Export an animation for every combination of the other axes into the output folder")
+    animate.add_argument("--format", default="gif", choices=["gif", "webp", "mp4", "webm"], help="Output format when using '--all'")
+    animate.add_argument("--workers", type=int, default=None, help="Worker processes when using '--all' (defaults to the CPU count)")
+    run = commands.add_parser("run", help="Run a grid file without the WebUI, generating through a dummy or HTTP backend")
+    run.add_argument("grid_file", help=f"Grid file name within the assets folder, one of: {', '.join(get_name_list())}")
+    run.add_argument("output", help="Base folder to write the grid output folder into")
+    run.add_argument("--name", help="Output folder name (defaults to the grid's 'outpath', or the file name)")
+    run.add_argument("--backend", default="dummy", choices=["dummy", "http"], help="'dummy' draws deterministic placeholder images, 'http' calls a txt2img API")
+    run.add_argument("--url", action="append", metavar="URL[@N]", help="Base URL of the txt2img API for the 'http' backend (default 'http://127.0.0.1:7860'), repeat to spread images across several servers. Add '@N' to have up to N images in flight on that server")
+    run.add_argument("--step-time", type=float, default=0, help="Seconds per step the 'dummy' backend waits, to simulate generation time")
+    run.add_argument("--dummy-backends", type=int, default=1, help="How many 'dummy' backends to spread images across")
+    run.add_argument("--concurrency", type=int, default=1, help="Images (or batches) to have in flight on each backend at once, for servers without their own '@N'")
+    run.add_argument("--set", action="append", metavar="MODE=VALUE", help="Base value for a setting, as in a grid file (eg 'prompt=a cat'), can be repeated")
+    run.add_argument("--overwrite", action="store_true", help="Overwrite existing images")
+    run.add_argument("--fast-skip", action="store_true", help="Skip values marked 'skip' entirely")
+    run.add_argument("--dry-run", action="store_true", help="Validate and plan the grid without generating")
+    run.add_argument("--no-page", action="store_true", help="Don't generate the web page")
+    run.add_argument("--no-metadata", action="store_true", help="Don't publish generation metadata to the web page")
+    run.add_argument("--skip-invalid", action="store_true", help="Skip invalid values instead of failing")
+    run.add_argument("--batch-size", type=int, default=1, help="Images to generate at once")
+    run.add_argument("--rebuild-changed", action="store_true", help="Regenerate images whose params changed since they were made")
+    run.add_argument("--cache-dir", help="Folder for the cross-run image cache (disabled if not given)")
+    run.add_argument("--save-workers", type=int, default=2, help="Background image save workers (0 saves inline)")
+    run.add_argument("--thumbnails", action="store_true", help="Write small thumbnails that the page loads when images are scaled down")
+    run.add_argument("--shard", metavar="INDEX/COUNT", help="Run only one part of the grid (eg '2/4'), to split a grid across machines and combine the parts with 'merge'")
+    run.add_argument("--profile", action="store_true", help="Write a timeline of where the run's time went to 'timeline.json' in the output folder (Chrome trace format)")
+    run.add_argument("--shard-mode", default="hash", choices=GridShard.MODES, help="Split cells by a stable hash of their path, or into contiguous ranges of the run order")
+    merge = commands.add_parser("merge", help="Combine the output folders of every shard of a sharded run into one grid output folder")
+    merge.add_argument("output", help="Folder to write the combined grid into")
+    merge.add_argument("shards", nargs="+", help="The output folder of each shard")
+    args = parser.parse_args(args)
+    try:
+        if args.command == "export":
+            export_composite(args.folder, args.output, args.x, args.y, args.x2, args.y2, parse_fixed_values(args.fixed), args.scale, args.tile_size, args.tile_format)
+        elif args.command == "animate" and args.all:
+            export_all_animations(args.folder, args.output, args.axis, args.format, args.speed, args.scale, args.reverse, args.quality, args.workers)
+        elif args.command == "animate":
+            count = export_animation(args.folder, args.output, args.axis, parse_fixed_values(args.fixed), args.speed, args.scale, args.reverse, args.quality)
+            print(f"Exported {count} frame animation of '{args.folder}' to '{args.output}'")
+        elif args.command == "run":
+            concurrency = args.concurrency
+            if args.backend == "http":
+                urls = [parse_backend_url(url, args.concurrency) for url in (args.url or ["http://127.0.0.1:7860"])]
+                backends = [HttpBackend(url) for url, _ in urls]
+                concurrency = [limit for _, limit in urls]
+            else:
+                backends = [DummyBackend(args.step_time) for _ in range(max(1, args.dummy_backends))]
+            start = time.perf_counter()
+            run_headless(backends, args.grid_file, args.output, args.name, parse_fixed_values(args.set), concurrency, do_overwrite=args.overwrite, fast_skip=args.fast_skip, generate_page=not args.no_page,
+                         publish_gen_metadata=not args.no_metadata, dry_run=args.dry_run, skip_invalid=args.skip_invalid, batch_size=args.batch_size, rebuild_changed=args.rebuild_changed,
+                         cache_dir=args.cache_dir, save_workers=args.save_workers, thumbnails=args.thumbnails, shard=GridShard.parse(args.shard, args.shard_mode) if args.shard else None, profile=args.profile)
+            print(f"Grid run finished in {time.perf_counter() - start:.1f} seconds")
+        elif args.command == "merge":
+            merge_grid_shards(args.shards, args.output)
+    except RuntimeError as e:
+        parser.exit(1, f"Error: {e}\n")
+
+if __name__ == "__main__":
+    main()
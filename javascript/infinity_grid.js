@@ -17,11 +17,16 @@ ex_titles = titles;
 new_titles = {
     "Select grid definition file": "Select the grid definition yaml file, in your '(extension)/assets' folder. Refer to the README for info.",
     "Overwrite existing images (for updating grids)": "If checked, any existing image files will be overwritten - this is useful if you want to redo the grid with completely different base settings. If unchecked, if an image already exists, it will be skipped - this is useful for adding new options to an existing grid.",
+    "Regenerate existing images whose settings changed": "If checked, existing images are only kept if they were generated with exactly the same settings (grid params, axis values, model, VAE, the generation settings in the UI such as highres fix, styles, refiner and img2img images, and always-on extensions like ControlNet) as they would be now. Any image whose settings changed is regenerated. Options from the Settings tab other than CLIP skip, ENSD and CodeFormer weight are not compared. Images made before this option existed have no recorded settings and will be regenerated once.",
     "Generate infinite-grid webviewer page": "If checked, generate the webviewer page. If unchecked, won't generate. You can uncheck this for dryruns that don't need it, or to avoid overwriting customized pages.",
     "Do a dry run to validate your grid file": "If checked, no images will be rendered - it will just validate your YAML and all its content. Check the WebUI's console for any messages.",
     "Publish full generation metadata for viewing on-page": "If checked, any/all image metadata will be stored in the webpage's files, and the internal values of each axis. This is useful for viewing, but if you're sharing a generation where some details are private (eg exact prompt text) you'll want to uncheck this. Note that this doesn't change whether metadata gets stored in images or not, edit your Settings tab to configure that.",
     "Use more-performant skipping": "Only matters if you have 'skip: true' on any values - if checked, uses a method of skipping that improves performance but prevents validation of the skipped options.",
-    "Validate PromptReplace input": "If unchecked, will allow useless PromptReplace settings to be ignored. If checked, will error if the replace won't do anything."
+    "Reuse identical images from other grids": "If checked, every generated image is also kept in a shared cache (in a '.infinity_grid_cache' folder in your grids output directory, hardlinked so it doesn't use extra space where possible). Any image with exactly the same settings in this or a later grid is taken from the cache instead of being generated again. The oldest cached images are removed once the cache passes 10 GiB.",
+    "Validate PromptReplace input": "If unchecked, will allow useless PromptReplace settings to be ignored. If checked, will error if the replace won't do anything.",
+    "Background image save workers": "How many images can be saved to file at the same time while generation continues. Generation pauses if saving falls too far behind. Set to 0 to save each image before generating the next.",
+    "Save images in separate processes": "If checked, the background save workers are separate processes, which is faster for large PNGs on many-core CPUs. Note that WebUI extensions that hook image saving won't run for grid images when this is checked.",
+    "Batch size for images that only differ by seed or prompt": "If above 1, images whose settings only differ in Seed, Var Seed, Prompt, Negative Prompt, or Prompt Replace will be generated together as one batch of up to this many images. Higher values use more VRAM but make better use of the GPU."
 }
 
 for (var i = 1; i <= 16; i++) {
@@ -12,7 +12,7 @@
 ##################
 
 import gradio as gr
-import os, numpy, threading
+import os, numpy
 from copy import copy
 from datetime import datetime
 from modules import images, shared, sd_models, sd_vae, sd_samplers, scripts, processing, ui_components
@@ -20,7 +20,7 @@ from modules.processing import process_images, Processed
 from modules.shared import opts, state
 from PIL import Image
 import gridgencore as core
-from gridgencore import clean_name, clean_mode, get_best_in_list, choose_better_file_name, GridSettingMode, fix_num, apply_field, registerMode
+from gridgencore import clean_name, clean_mode, get_best_in_list, get_name_index, choose_better_file_name, GridSettingMode, fix_num, apply_field, registerMode, prompt_replace_parse_list, apply_prompt_replace
 
 ######################### Constants #########################
 refresh_symbol = '\U0001f504'  # 🔄
@@ -31,8 +31,11 @@ core.EXTRA_ASSETS = ["a1111webui.js"]
 
 ######################### Value Mode Helpers #########################
 
+def list_model_titles():
+    return list(map(lambda m: m.title, sd_models.checkpoints_list.values()))
+
 def get_model_for(name):
-    return get_best_in_list(name, map(lambda m: m.title, sd_models.checkpoints_list.values()))
+    return get_name_index("models", list_model_titles).find(name)
 
 def apply_model(p, v):
     opts.sd_model_checkpoint = get_model_for(v)
@@ -41,11 +44,11 @@ def apply_model(p, v):
 def clean_model(p, v):
     actual_model = get_model_for(v)
     if actual_model is None:
-        raise RuntimeError(f"Invalid parameter '{p}' as '{v}': model name unrecognized - valid {list(map(lambda m: m.title, sd_models.checkpoints_list.values()))}")
+        raise RuntimeError(f"Invalid parameter '{p}' as '{v}': model name unrecognized - valid {list_model_titles()}")
     return choose_better_file_name(v, actual_model)
 
 def get_vae_for(name):
-    return get_best_in_list(name, sd_vae.vae_dict.keys())
+    return get_name_index("vaes", lambda: sd_vae.vae_dict.keys()).find(name)
 
 def apply_vae(p, v):
     vae_name = clean_name(v)
@@ -80,29 +83,6 @@ def apply_restore_faces(p, v):
     if restorer is not None:
         opts.face_restoration_model = restorer
 
-def prompt_replace_parse_list(in_list):
-    if not any(('=' in x) for x in in_list):
-        first_val = in_list[0]
-        for x in range(0, len(in_list)):
-            in_list[x] = {
-                "title": in_list[x],
-                "params": {
-                    "promptreplace": f"{first_val}={in_list[x]}"
-                }
-            }
-    return in_list
-
-def apply_prompt_replace(p, v):
-    val = v.split('=', maxsplit=1)
-    if len(val) != 2:
-        raise RuntimeError(f"Invalid prompt replace, missing '=' symbol, for '{v}'")
-    match = val[0].strip()
-    replace = val[1].strip()
-    if Script.VALIDATE_REPLACE and match not in p.prompt and match not in p.negative_prompt:
-        raise RuntimeError(f"Invalid prompt replace, '{match}' is not in prompt '{p.prompt}' nor negative prompt '{p.negative_prompt}'")
-    p.prompt = p.prompt.replace(match, replace)
-    p.negative_prompt = p.negative_prompt.replace(match, replace)
-
 def apply_enable_hr(p, v):
     p.enable_hr = v
     if v:
@@ -125,29 +105,30 @@ def try_init():
     if has_inited:
         return
     has_inited = True
-    core.grid_call_init_hook = a1111_grid_call_init_hook
     core.grid_call_param_add_hook = a1111_grid_call_param_add_hook
     core.grid_call_apply_hook = a1111_grid_call_apply_hook
     core.grid_runner_pre_run_hook = a1111_grid_runner_pre_run_hook
     core.grid_runner_pre_dry_hook = a1111_grid_runner_pre_dry_hook
     core.grid_runner_post_dry_hook = a1111_grid_runner_post_dry_hook
+    core.grid_runner_post_dry_batch_hook = a1111_grid_runner_post_dry_batch_hook
     core.grid_runner_count_steps = a1111_grid_runner_count_steps
     core.webdata_get_base_param_data = a1111_webdata_get_base_param_data
-    registerMode("Model", GridSettingMode(dry=False, type="text", apply=apply_model, clean=clean_model, valid_list=lambda: list(map(lambda m: m.title, sd_models.checkpoints_list.values()))))
-    registerMode("VAE", GridSettingMode(dry=False, type="text", apply=apply_vae, clean=clean_vae, valid_list=lambda: list(sd_vae.vae_dict.keys()) + ['none', 'auto', 'automatic']))
+    core.grid_runner_get_extra_state = a1111_get_extra_state
+    registerMode("Model", GridSettingMode(dry=False, type="text", apply=apply_model, clean=clean_model, switch_cost=10, valid_list=list_model_titles))
+    registerMode("VAE", GridSettingMode(dry=False, type="text", apply=apply_vae, clean=clean_vae, switch_cost=3, valid_list=lambda: list(sd_vae.vae_dict.keys()) + ['none', 'auto', 'automatic']))
     registerMode("Sampler", GridSettingMode(dry=True, type="text", apply=apply_field("sampler_name"), valid_list=lambda: list(sd_samplers.all_samplers_map.keys())))
-    registerMode("Seed", GridSettingMode(dry=True, type="integer", apply=apply_field("seed")))
+    registerMode("Seed", GridSettingMode(dry=True, type="integer", apply=apply_field("seed"), batchable=True))
     registerMode("Steps", GridSettingMode(dry=True, type="integer", min=0, max=200, apply=apply_field("steps")))
     registerMode("CFG Scale", GridSettingMode(dry=True, type="decimal", min=0, max=500, apply=apply_field("cfg_scale")))
     registerMode("Width", GridSettingMode(dry=True, type="integer", apply=apply_field("width")))
     registerMode("Height", GridSettingMode(dry=True, type="integer", apply=apply_field("height")))
-    registerMode("Prompt", GridSettingMode(dry=True, type="text", apply=apply_field("prompt")))
-    registerMode("Negative Prompt", GridSettingMode(dry=True, type="text", apply=apply_field("negative_prompt")))
-    registerMode("Prompt Replace", GridSettingMode(dry=True, type="text", apply=apply_prompt_replace, parse_list=prompt_replace_parse_list))
+    registerMode("Prompt", GridSettingMode(dry=True, type="text", apply=apply_field("prompt"), batchable=True))
+    registerMode("Negative Prompt", GridSettingMode(dry=True, type="text", apply=apply_field("negative_prompt"), batchable=True))
+    registerMode("Prompt Replace", GridSettingMode(dry=True, type="text", apply=apply_prompt_replace, parse_list=prompt_replace_parse_list, batchable=True))
     registerMode("Styles", GridSettingMode(dry=True, type="text", apply=apply_styles, valid_list=lambda: list(shared.prompt_styles.styles)))
-    registerMode("Var Seed", GridSettingMode(dry=True, type="integer", apply=apply_field("subseed")))
+    registerMode("Var Seed", GridSettingMode(dry=True, type="integer", apply=apply_field("subseed"), batchable=True))
     registerMode("Var Strength", GridSettingMode(dry=True, type="decimal", min=0, max=1, apply=apply_field("subseed_strength")))
-    registerMode("ClipSkip", GridSettingMode(dry=False, type="integer", min=1, max=12, apply=apply_setting_override("CLIP_stop_at_last_layers")))
+    registerMode("ClipSkip", GridSettingMode(dry=False, type="integer", min=1, max=12, apply=apply_setting_override("CLIP_stop_at_last_layers"), switch_cost=1))
     registerMode("Denoising", GridSettingMode(dry=True, type="decimal", min=0, max=1, apply=apply_field("denoising_strength")))
     registerMode("ETA", GridSettingMode(dry=True, type="decimal", min=0, max=1, apply=apply_field("eta")))
     registerMode("Sigma Churn", GridSettingMode(dry=True, type="decimal", min=0, max=1, apply=apply_field("s_churn")))
@@ -170,7 +151,7 @@ def try_init():
     registerMode("HighRes Upscale to Height", GridSettingMode(dry=True, type="integer", apply=apply_field("hr_upscale_to_y")))
     registerMode("HighRes Upscaler", GridSettingMode(dry=True, type="text", apply=apply_field("hr_upscaler"), valid_list=lambda: list(map(lambda u: u.name, shared.sd_upscalers)) + list(shared.latent_upscale_modes.keys())))
     registerMode("HighRes Sampler", GridSettingMode(dry=True, type="text", apply=apply_field("hr_sampler_name"), valid_list=lambda: list(sd_samplers.all_samplers_map.keys())))
-    registerMode("HighRes Checkpoint", GridSettingMode(dry=False, type="text", apply=apply_field("hr_checkpoint_name"), clean=clean_model, valid_list=lambda: list(map(lambda m: m.title, sd_models.checkpoints_list.values()))))
+    registerMode("HighRes Checkpoint", GridSettingMode(dry=False, type="text", apply=apply_field("hr_checkpoint_name"), clean=clean_model, switch_cost=5, valid_list=lambda: list(map(lambda m: m.title, sd_models.checkpoints_list.values()))))
     registerMode("Image CFG Scale", GridSettingMode(dry=True, type="decimal", min=0, max=500, apply=apply_field("image_cfg_scale")))
     registerMode("Use Result Index", GridSettingMode(dry=True, type="integer", min=0, max=500, apply=apply_field("inf_grid_use_result_index")))
     try:
@@ -214,9 +195,6 @@ def try_init():
 
 ######################### Actual Execution Logic #########################
 
-def a1111_grid_call_init_hook(grid_call: core.SingleGridCall):
-    grid_call.replacements = list()
-
 def a1111_grid_call_param_add_hook(grid_call: core.SingleGridCall, param: str, value):
     if grid_call.grid.min_width is None:
         grid_call.grid.min_width = grid_call.grid.initial_p.width
@@ -224,7 +202,9 @@ def a1111_grid_call_param_add_hook(grid_call: core.SingleGridCall, param: str, v
         grid_call.grid.min_height = grid_call.grid.initial_p.height
     cleaned = clean_mode(param)
     if cleaned == "promptreplace":
-        grid_call.replacements.append(value)
+        if grid_call.hook_data is None:
+            grid_call.hook_data = {}
+        grid_call.hook_data.setdefault('replacements', []).append(value)
         return True
     elif cleaned in ["width", "outwidth"]:
         grid_call.grid.min_width = min(grid_call.grid.min_width or 99999, int(value))
@@ -233,10 +213,23 @@ def a1111_grid_call_param_add_hook(grid_call: core.SingleGridCall, param: str, v
     return False
 
 def a1111_grid_call_apply_hook(grid_call: core.SingleGridCall, param: str, dry: bool):
-    for replace in grid_call.replacements:
+    for replace in (grid_call.hook_data or {}).get('replacements', []):
         apply_prompt_replace(param, replace)
-    
+    if not dry:
+        # Only go back to the base model/VAE when this image doesn't pick one, so shared ones stay loaded
+        modes = [clean_mode(p) for p in grid_call.params.keys()]
+        if "model" not in modes and opts.sd_model_checkpoint != grid_call.runner.base_model:
+            opts.sd_model_checkpoint = grid_call.runner.base_model
+            sd_models.reload_model_weights()
+        if "vae" not in modes and opts.sd_vae != grid_call.runner.base_vae:
+            opts.sd_vae = grid_call.runner.base_vae
+            sd_vae.reload_vae_weights(None)
+
 def a1111_grid_runner_pre_run_hook(grid_runner: core.GridRunner):
+    if len(core.get_save_args(grid_runner.grid.format, grid_runner.grid.encode_options)) > 0:
+        print("Infinity Grid Generator: this grid sets encode options, so images are saved directly rather than through the WebUI's image saving (its save settings and extension save callbacks won't apply)")
+    grid_runner.base_model = opts.sd_model_checkpoint
+    grid_runner.base_vae = opts.sd_vae
     state.job_count = grid_runner.total_run
     shared.total_tqdm.updateTotal(grid_runner.total_steps)
     # prevents the steps from from being recalculated by Auto1 using the current value of hires steps
@@ -248,37 +241,83 @@ def a1111_grid_runner_pre_dry_hook(grid_runner: core.GridRunner):
     grid_runner.temp = TempHolder()
     grid_runner.temp.old_codeformer_weight = opts.code_former_weight
     grid_runner.temp.old_face_restorer = opts.face_restoration_model
-    grid_runner.temp.old_vae = opts.sd_vae
-    grid_runner.temp.old_model = opts.sd_model_checkpoint
 
-def a1111_grid_runner_post_dry_hook(grid_runner: core.GridRunner, p, set):
-    p.seed = processing.get_fixed_seed(p.seed)
-    p.subseed = processing.get_fixed_seed(p.subseed)
-    processed = process_images(p)
-    if len(processed.images) < 1:
-        raise RuntimeError(f"Something went wrong! Image gen '{set.data}' produced {len(processed.images)} images, which is wrong")
+def a1111_save_grid_image(grid_runner: core.GridRunner, p, set, img, seed):
     os.makedirs(os.path.dirname(set.filepath), exist_ok=True)
-    result_index = getattr(p, 'inf_grid_use_result_index', 0)
-    if result_index >= len(processed.images):
-        result_index = len(processed.images) - 1
-    img = processed.images[result_index]
     if type(img) == numpy.ndarray:
         img = Image.fromarray(img)
     if hasattr(p, 'inf_grid_out_width') and hasattr(p, 'inf_grid_out_height'):
         img = img.resize((p.inf_grid_out_width, p.inf_grid_out_height), resample=images.LANCZOS)
-    processed.images[result_index] = img
     info = processing.create_infotext(p, [p.prompt], [p.seed], [p.subseed], [])
     ext = grid_runner.grid.format
     prompt = p.prompt
-    seed = processed.seed
-    def save_offthread():
-        images.save_image(img, path=os.path.dirname(set.filepath), basename="", forced_filename=os.path.basename(set.filepath), save_to_dirs=False, info=info, extension=ext, p=p, prompt=prompt, seed=seed)
-    threading.Thread(target=save_offthread).start()
+    grid_runner.add_image_metadata(set, {'parameters': info})
+    options = grid_runner.grid.encode_options
+    args = (img, set.filepath + "." + ext, ext, info, options, grid_runner.get_thumbnail_paths(set))
+    def save():
+        # Grid encode settings are applied at the first save, so lossy images aren't encoded twice
+        if len(core.get_save_args(ext, options)) > 0:
+            core.save_image_file(*args)
+            return
+        # Saved under a temporary name then renamed into place, so a crash never leaves a partly written image
+        temp, _ = images.save_image(img, path=os.path.dirname(set.filepath), basename="", forced_filename=os.path.basename(set.filepath) + ".tmp", save_to_dirs=False, info=info, extension=ext, p=p, prompt=prompt, seed=seed)
+        os.replace(temp, set.filepath + "." + ext)
+        core.write_derived_files(img, set.filepath, {'parameters': info}, options, args[5])
+    on_done = lambda: grid_runner.on_image_saved(set, encoded=True)
+    if grid_runner.save_queue is None:
+        with grid_runner.profiler.span("save", "io", cell=set.relative_path):
+            save()
+        on_done()
+    elif grid_runner.save_queue.use_processes:
+        grid_runner.save_queue.submit(core.save_image_file, *args, on_done=on_done)
+    else:
+        grid_runner.save_queue.submit(save, on_done=on_done)
+    return img
+
+def a1111_restore_opts(grid_runner: core.GridRunner):
     opts.code_former_weight = grid_runner.temp.old_codeformer_weight
     opts.face_restoration_model = grid_runner.temp.old_face_restorer
-    opts.sd_vae = grid_runner.temp.old_vae
-    opts.sd_model_checkpoint = grid_runner.temp.old_model
     grid_runner.temp = None
+
+def a1111_process_single(grid_runner: core.GridRunner, p, set):
+    p.seed = processing.get_fixed_seed(p.seed)
+    p.subseed = processing.get_fixed_seed(p.subseed)
+    with grid_runner.profiler.span("process_images", "cell", cell=set.relative_path):
+        processed = process_images(p)
+    if len(processed.images) < 1:
+        raise RuntimeError(f"Something went wrong! Image gen '{set.data}' produced {len(processed.images)} images, which is wrong")
+    result_index = getattr(p, 'inf_grid_use_result_index', 0)
+    if result_index >= len(processed.images):
+        result_index = len(processed.images) - 1
+    processed.images[result_index] = a1111_save_grid_image(grid_runner, p, set, processed.images[result_index], processed.seed)
+    return processed
+
+def a1111_grid_runner_post_dry_hook(grid_runner: core.GridRunner, p, set):
+    processed = a1111_process_single(grid_runner, p, set)
+    a1111_restore_opts(grid_runner)
+    return processed
+
+def a1111_grid_runner_post_dry_batch_hook(grid_runner: core.GridRunner, batch: list):
+    if any(hasattr(p, 'inf_grid_use_result_index') for p, _ in batch):
+        # Extra result images (eg ControlNet maps) don't have a well-defined order within a batch, so run these one at a time
+        processed = [a1111_process_single(grid_runner, p, set) for p, set in batch][-1]
+        a1111_restore_opts(grid_runner)
+        return processed
+    batch_p = copy(batch[0][0])
+    batch_p.batch_size = len(batch)
+    batch_p.prompt = [p.prompt for p, _ in batch]
+    batch_p.negative_prompt = [p.negative_prompt for p, _ in batch]
+    batch_p.seed = [processing.get_fixed_seed(p.seed) for p, _ in batch]
+    batch_p.subseed = [processing.get_fixed_seed(p.subseed) for p, _ in batch]
+    with grid_runner.profiler.span("process_images", "cell", cells=[set.relative_path for _, set in batch]):
+        processed = process_images(batch_p)
+    if len(processed.images) < len(batch):
+        raise RuntimeError(f"Something went wrong! Batched image gen of {len(batch)} images for '{batch[0][1].data}' produced {len(processed.images)} images, which is wrong")
+    for i, (p, set) in enumerate(batch):
+        p.seed = processed.all_seeds[i]
+        p.subseed = processed.all_subseeds[i]
+        processed.images[i] = a1111_save_grid_image(grid_runner, p, set, processed.images[i], p.seed)
+    a1111_restore_opts(grid_runner)
     return processed
 
 def a1111_grid_runner_count_steps(grid_runner: core.GridRunner, set):
@@ -320,6 +359,19 @@ def a1111_webdata_get_base_param_data(p):
         "ENSD": None if opts.eta_noise_seed_delta == 0 else opts.eta_noise_seed_delta
     }
 
+# Processing fields that change the image but aren't in the page metadata (not every WebUI version has all of them)
+A1111_EXTRA_STATE_FIELDS = ["enable_hr", "hr_scale", "hr_upscaler", "hr_second_pass_steps", "hr_resize_x", "hr_resize_y", "hr_checkpoint_name", "hr_sampler_name", "hr_scheduler", "hr_prompt", "hr_negative_prompt",
+                            "styles", "scheduler", "refiner_checkpoint", "refiner_switch_at", "tiling", "seed_resize_from_w", "seed_resize_from_h", "init_images", "image_mask", "resize_mode",
+                            "mask_blur_x", "mask_blur_y", "inpainting_fill", "inpaint_full_res", "inpaint_full_res_padding", "inpainting_mask_invert", "image_cfg_scale", "initial_noise_multiplier"]
+
+def a1111_get_extra_state(p):
+    state = {field: getattr(p, field) for field in A1111_EXTRA_STATE_FIELDS if hasattr(p, field)}
+    # Always-on scripts (eg ControlNet) read their args from the shared list; this script's own UI args are left out
+    if getattr(p, 'scripts', None) is not None and p.script_args is not None:
+        for script in p.scripts.alwayson_scripts:
+            state[f"script {script.title()}"] = list(p.script_args[script.args_from:script.args_to])
+    return state
+
 class SettingsFixer():
     def __enter__(self):
         self.model = opts.sd_model_checkpoint
@@ -338,7 +390,6 @@ class SettingsFixer():
 ######################### Script class entrypoint #########################
 class Script(scripts.Script):
     BASEDIR = scripts.basedir()
-    VALIDATE_REPLACE = True
 
     def title(self):
         return "Generate Infinite-Axis Grid"
@@ -439,16 +490,23 @@ class Script(scripts.Script):
         grid_file.change(fn=update_page_url, inputs=[output_file_path, grid_file], outputs=[output_file_path, page_will_be])
         with gr.Row():
             do_overwrite = gr.Checkbox(value=False, label="Overwrite existing images (for updating grids)")
+            rebuild_changed = gr.Checkbox(value=False, label="Regenerate existing images whose settings changed")
             dry_run = gr.Checkbox(value=False, label="Do a dry run to validate your grid file")
             fast_skip = gr.Checkbox(value=False, label="Use more-performant skipping")
             skip_invalid = gr.Checkbox(value=False, label="Skip invalid entries")
+            batch_size = gr.Slider(minimum=1, maximum=32, step=1, value=1, label="Batch size for images that only differ by seed or prompt")
         with gr.Row():
             generate_page = gr.Checkbox(value=True, label="Generate infinite-grid webviewer page")
             validate_replace = gr.Checkbox(value=True, label="Validate PromptReplace input")
             publish_gen_metadata = gr.Checkbox(value=True, label="Publish full generation metadata for viewing on-page")
-        return [do_overwrite, generate_page, dry_run, validate_replace, publish_gen_metadata, grid_file, fast_skip, output_file_path, skip_invalid] + manual_axes
-
-    def run(self, p, do_overwrite, generate_page, dry_run, validate_replace, publish_gen_metadata, grid_file, fast_skip, output_file_path, skip_invalid, *manual_axes):
+            use_cache = gr.Checkbox(value=False, label="Reuse identical images from other grids")
+            save_processes = gr.Checkbox(value=False, label="Save images in separate processes")
+            save_workers = gr.Slider(minimum=0, maximum=16, step=1, value=2, label="Background image save workers")
+            profile = gr.Checkbox(value=False, label="Write a timing timeline of the run (timeline.json)")
+            thumbnails = gr.Checkbox(value=False, label="Write thumbnails for faster page loading")
+        return [do_overwrite, generate_page, dry_run, validate_replace, publish_gen_metadata, grid_file, fast_skip, output_file_path, skip_invalid, batch_size, rebuild_changed, use_cache, save_workers, save_processes, profile, thumbnails] + manual_axes
+
+    def run(self, p, do_overwrite, generate_page, dry_run, validate_replace, publish_gen_metadata, grid_file, fast_skip, output_file_path, skip_invalid, batch_size, rebuild_changed, use_cache, save_workers, save_processes, profile, thumbnails, *manual_axes):
         core.clear_caches()
         try_init()
         # Clean up default params
@@ -459,7 +517,7 @@ class Script(scripts.Script):
         p.do_not_save_grid = True
         p.seed = processing.get_fixed_seed(p.seed)
         # Store extra variable
-        Script.VALIDATE_REPLACE = validate_replace
+        core.VALIDATE_REPLACE = validate_replace
         # Validate to avoid abuse
         if '..' in grid_file or grid_file == "":
             raise RuntimeError(f"Unacceptable filename '{grid_file}'")
@@ -472,7 +530,8 @@ class Script(scripts.Script):
         else:
             manual_axes = None
         with SettingsFixer():
-            result = core.run_grid_gen(p, grid_file, p.outpath_grids, output_file_path, do_overwrite, fast_skip, generate_page, publish_gen_metadata, dry_run, manual_axes, skip_invalid=skip_invalid)
+            result = core.run_grid_gen(p, grid_file, p.outpath_grids, output_file_path, do_overwrite, fast_skip, generate_page, publish_gen_metadata, dry_run, manual_axes, skip_invalid=skip_invalid, batch_size=int(batch_size), rebuild_changed=rebuild_changed,
+                                        cache_dir=(p.outpath_grids + "/.infinity_grid_cache" if use_cache else None), save_workers=int(save_workers), save_processes=save_processes, profile=profile, thumbnails=thumbnails)
         if result is None:
             return Processed(p, list())
         return result
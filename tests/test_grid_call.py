@@ -0,0 +1,29 @@
+import os, sys, pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gridgencore as core
+
+def run_grid(tmp_path):
+    backend = core.DummyBackend()
+    core.run_headless(backend, "", str(tmp_path), "grid", {"prompt": "a cat"}, manual_pairs=["seed", "1, 2"], generate_page=False)
+
+def test_init_hook_can_store_data_in_hook_data(tmp_path, monkeypatch):
+    seen = []
+    def init_hook(grid_call):
+        grid_call.hook_data = grid_call.hook_data or {}
+        grid_call.hook_data['seen'] = True
+        seen.append(grid_call)
+    original_install = core.GridBackend.install
+    def install(self):
+        original_install(self)
+        core.grid_call_init_hook = init_hook
+    monkeypatch.setattr(core.GridBackend, "install", install)
+    run_grid(tmp_path)
+    assert len(seen) > 0
+    assert all(grid_call.hook_data['seen'] for grid_call in seen)
+
+def test_calls_have_no_instance_dict():
+    assert '__dict__' not in core.SingleGridCall.__slots__
+    grid_call = core.SingleGridCall.__new__(core.SingleGridCall)
+    with pytest.raises(AttributeError):
+        grid_call.replacements = []
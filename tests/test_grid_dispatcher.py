@@ -0,0 +1,97 @@
+import os, sys, threading, pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gridgencore as core
+
+class FakeRunner:
+    def __init__(self):
+        self.profiler = core.GridProfiler()
+        self.done = []
+
+    def unlink_cached_outputs(self, batch):
+        pass
+
+    def mark_done(self, set):
+        self.done.append(set)
+
+class FakeCall:
+    data = "fake cell"
+    relative_path = "1/1"
+
+class FailingBackend(core.GridBackend):
+    def post_dry_batch_hook(self, grid_runner, batch):
+        raise RuntimeError("backend is down")
+
+def run_with_timeout(func, timeout=10):
+    result = {}
+    def target():
+        try:
+            result['value'] = func()
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "dispatch hung"
+    return result
+
+def test_dispatch_fails_when_every_backend_fails():
+    dispatcher = core.GridDispatcher([FailingBackend(), FailingBackend()])
+    runner = FakeRunner()
+    result = run_with_timeout(lambda: dispatcher.run(runner, [[(core.HeadlessParams(), FakeCall())]]))
+    assert isinstance(result.get('error'), RuntimeError)
+    assert "every available backend" in str(result['error'])
+    assert runner.done == []
+
+def test_dispatch_fails_when_every_backend_fails_with_concurrency():
+    dispatcher = core.GridDispatcher([FailingBackend(), FailingBackend()], concurrency=3)
+    runner = FakeRunner()
+    batches = [[(core.HeadlessParams(), FakeCall())] for _ in range(5)]
+    result = run_with_timeout(lambda: dispatcher.run(runner, batches))
+    assert isinstance(result.get('error'), RuntimeError)
+
+class CountingBackend(core.GridBackend):
+    def __init__(self, barrier=None):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.barrier = barrier
+
+    def post_dry_batch_hook(self, grid_runner, batch):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            if self.barrier is not None:
+                self.barrier.wait()
+            else:
+                threading.Event().wait(0.01)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+def test_dispatch_keeps_to_each_backend_limit():
+    backends = [CountingBackend(), CountingBackend()]
+    dispatcher = core.GridDispatcher(backends, concurrency=[1, 3])
+    runner = FakeRunner()
+    batches = [[(core.HeadlessParams(), FakeCall())] for _ in range(30)]
+    result = run_with_timeout(lambda: dispatcher.run(runner, batches))
+    assert 'error' not in result
+    assert len(runner.done) == 30
+    assert backends[0].peak == 1
+    assert 1 < backends[1].peak <= 3
+
+def test_dispatch_runs_more_than_the_default_executor_allows():
+    # Every batch waits until 40 are in flight together, which only happens if the thread pool is sized to the limit
+    backend = CountingBackend(threading.Barrier(40, timeout=5))
+    dispatcher = core.GridDispatcher([backend], concurrency=40)
+    runner = FakeRunner()
+    batches = [[(core.HeadlessParams(), FakeCall())] for _ in range(40)]
+    result = run_with_timeout(lambda: dispatcher.run(runner, batches))
+    assert 'error' not in result
+    assert backend.peak == 40
+
+def test_parse_backend_url():
+    assert core.parse_backend_url("http://127.0.0.1:7860@4", 1) == ("http://127.0.0.1:7860", 4)
+    assert core.parse_backend_url("http://127.0.0.1:7860", 2) == ("http://127.0.0.1:7860", 2)
+    assert core.parse_backend_url("http://user@host:7860", 1) == ("http://user@host:7860", 1)
@@ -0,0 +1,109 @@
+import os, sys, io, json, base64, threading, pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gridgencore as core
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers the WebUI API endpoints that HttpBackend uses, recording every txt2img payload it gets."""
+    def log_message(self, *args):
+        pass
+
+    def send(self, data, code: int = 200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/sdapi/v1/sd-models":
+            self.send([{"title": "modelA.safetensors [abc]"}, {"title": "modelB.safetensors [def]"}])
+        elif self.path == "/sdapi/v1/samplers":
+            self.send([{"name": "Euler a"}, {"name": "DDIM"}])
+        elif self.path == "/sdapi/v1/options":
+            self.send({"sd_model_checkpoint": "modelA.safetensors [abc]"})
+        else:
+            self.send({"detail": "Not Found"}, 404)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.payloads.append(payload)
+        mode = self.server.mode
+        if mode == "error":
+            return self.send({"error": "OutOfMemoryError"}, 500)
+        if mode == "empty":
+            return self.send({"images": [], "info": "{}"})
+        buffer = io.BytesIO()
+        Image.new("RGB", (payload["width"], payload["height"]), (payload["seed"] % 256, payload["steps"], 7)).save(buffer, format="PNG")
+        image = base64.b64encode(buffer.getvalue()).decode('ascii')
+        if mode == "data_url":
+            image = "data:image/png;base64," + image
+        info = json.dumps({"infotexts": [f"{payload['prompt']}\nSteps: {payload['steps']}, Seed: {payload['seed']}"]}) if mode != "no_info" else ""
+        self.send({"images": [image], "info": info})
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.payloads = []
+    server.mode = "ok"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def get_backend(server):
+    return core.HttpBackend(f"http://127.0.0.1:{server.server_address[1]}/", timeout=10)
+
+def test_lists_and_base_model(stub_server):
+    backend = get_backend(stub_server)
+    assert backend.list_models() == ["modelA.safetensors [abc]", "modelB.safetensors [def]"]
+    assert backend.list_samplers() == ["Euler a", "DDIM"]
+    assert backend.get_base_model() == "modelA.safetensors [abc]"
+
+def test_payload_and_result(stub_server):
+    backend = get_backend(stub_server)
+    p = core.HeadlessParams(prompt="a cat", negative_prompt="blurry", seed=5, steps=12, width=64, height=32, model="modelB.safetensors [def]", denoising_strength=0.4)
+    img, info = backend.generate(p)
+    payload = stub_server.payloads[0]
+    assert payload["prompt"] == "a cat"
+    assert payload["negative_prompt"] == "blurry"
+    assert (payload["seed"], payload["steps"], payload["width"], payload["height"]) == (5, 12, 64, 32)
+    assert payload["sampler_name"] == "Euler a"
+    assert payload["denoising_strength"] == 0.4
+    assert payload["override_settings"] == {"sd_model_checkpoint": "modelB.safetensors [def]"}
+    assert payload["send_images"] and not payload["save_images"]
+    assert img.size == (64, 32)
+    assert img.convert("RGB").getpixel((0, 0)) == (5, 12, 7)
+    assert info == "a cat\nSteps: 12, Seed: 5"
+
+def test_payload_without_model_leaves_the_server_model(stub_server):
+    backend = get_backend(stub_server)
+    backend.generate(core.HeadlessParams(seed=1, width=8, height=8))
+    payload = stub_server.payloads[0]
+    assert "override_settings" not in payload
+    assert "denoising_strength" not in payload
+
+def test_decodes_data_urls_and_builds_missing_info(stub_server):
+    backend = get_backend(stub_server)
+    stub_server.mode = "data_url"
+    img, _ = backend.generate(core.HeadlessParams(seed=2, steps=3, width=8, height=8))
+    assert img.convert("RGB").getpixel((0, 0)) == (2, 3, 7)
+    stub_server.mode = "no_info"
+    p = core.HeadlessParams(prompt="a dog", seed=2, steps=3, width=8, height=8)
+    _, info = backend.generate(p)
+    assert info == core.build_infotext(p)
+
+def test_errors(stub_server):
+    backend = get_backend(stub_server)
+    stub_server.mode = "error"
+    with pytest.raises(RuntimeError, match="HTTP 500"):
+        backend.generate(core.HeadlessParams(seed=1, width=8, height=8))
+    stub_server.mode = "empty"
+    with pytest.raises(RuntimeError, match="no images"):
+        backend.generate(core.HeadlessParams(seed=1, width=8, height=8))
+    with pytest.raises(RuntimeError, match="Cannot reach backend"):
+        core.HttpBackend("http://127.0.0.1:9", timeout=2).list_models()
@@ -0,0 +1,13 @@
+import os, sys, pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gridgencore as core
+
+def test_failed_submit_releases_its_slot():
+    queue = core.ImageSaveQueue(1, max_pending=1)
+    queue.executor.shutdown()
+    with pytest.raises(RuntimeError):
+        queue.submit(print, "never runs")
+    assert queue.depth == 0
+    queue.drain()
+    assert queue.slots.acquire(blocking=False)
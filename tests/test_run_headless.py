@@ -0,0 +1,68 @@
+import os, sys, glob
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gridgencore as core
+
+AXES = ["seed", "1, 2, 3", "steps", "10, 20"]
+
+class CountingBackend(core.DummyBackend):
+    def __init__(self):
+        super().__init__()
+        self.generated = []
+
+    def generate(self, p):
+        self.generated.append((p.prompt, p.seed, p.steps))
+        return super().generate(p)
+
+def run(folder, axes=AXES, backend=None, **kwargs):
+    backend = backend or CountingBackend()
+    core.run_headless(backend, "", os.path.dirname(folder), os.path.basename(folder), {"prompt": "a cat"}, manual_pairs=list(axes), generate_page=True, **kwargs)
+    return backend
+
+def list_images(folder):
+    return sorted(os.path.relpath(path, folder) for path in glob.glob(folder + "/[0-9]*/**/*.png", recursive=True))
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_resume_only_redoes_missing_and_unfinished_images(tmp_path):
+    folder = str(tmp_path / "grid")
+    assert len(run(folder).generated) == 6
+    assert run(folder).generated == []
+    os.remove(folder + "/2/1.png")
+    # As if the previous run was killed after generating this image but before it was saved
+    journal = core.RunJournal(folder + "/journal.log")
+    journal.record("3/2", "generated")
+    journal.close()
+    assert sorted(run(folder).generated) == [("a cat", 2, 10), ("a cat", 3, 20)]
+    assert len(list_images(folder)) == 6
+    assert run(folder).generated == []
+
+def test_identical_images_are_generated_once(tmp_path):
+    folder = str(tmp_path / "grid")
+    backend = run(folder, ["prompt replace", "cat=cat || zebra=horse", "seed", "1, 2"])
+    assert len(backend.generated) == 2
+    for seed in ["1", "2"]:
+        assert read(f"{folder}/1/{seed}.png") == read(f"{folder}/2/{seed}.png")
+
+def test_random_variation_seeds_are_not_deduplicated(tmp_path):
+    folder = str(tmp_path / "grid")
+    backend = run(folder, ["var seed", "-1, -1", "var strength", "0.5"])
+    assert len(backend.generated) == 2
+
+def test_shards_merge_into_the_full_grid(tmp_path):
+    # Grids built from manual axes take their title from the output folder name, which has to match between shards
+    full = str(tmp_path / "full" / "grid")
+    run(full)
+    shards = []
+    for index in [1, 2]:
+        folder = str(tmp_path / f"shard{index}" / "grid")
+        run(folder, shard=core.GridShard.parse(f"{index}/2"))
+        shards.append(folder)
+    assert sum(len(list_images(folder)) for folder in shards) == 6
+    merged = str(tmp_path / "merged")
+    core.merge_grid_shards(shards, merged)
+    assert list_images(merged) == list_images(full)
+    for name in list_images(full):
+        assert read(f"{merged}/{name}") == read(f"{full}/{name}")
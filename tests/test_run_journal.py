@@ -0,0 +1,29 @@
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gridgencore as core
+
+def test_inline_save_is_not_downgraded(tmp_path):
+    image = tmp_path / "1" / "1.png"
+    image.parent.mkdir()
+    image.write_bytes(b"image")
+    journal = core.RunJournal(str(tmp_path / "journal.log"))
+    journal.record("1/1", "queued")
+    journal.record_saved("1/1", str(image))
+    journal.record("1/1", "generated")
+    journal.close()
+    reloaded = core.RunJournal(str(tmp_path / "journal.log"))
+    assert reloaded.state("1/1") == "saved"
+    assert reloaded.get_unsaved() == []
+
+def test_requeued_image_is_unsaved_until_saved_again(tmp_path):
+    image = tmp_path / "1.png"
+    image.write_bytes(b"image")
+    journal = core.RunJournal(str(tmp_path / "journal.log"))
+    journal.record_saved("1", str(image))
+    journal.close()
+    journal = core.RunJournal(str(tmp_path / "journal.log"))
+    journal.record("1", "queued")
+    journal.record("1", "generated")
+    assert journal.state("1") == "generated"
+    journal.close()